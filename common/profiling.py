@@ -0,0 +1,210 @@
+import cProfile
+import math
+import pstats
+import threading
+import time
+import tracemalloc
+from argparse import ArgumentParser, Namespace
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from typing import Dict, List
+
+# Пока сбор статистики выключен, span() и increment() сводятся к одной проверке флага
+_stats_enabled = False
+# Длительности всех завершённых отрезков (span), в секундах: {имя отрезка: [длительность, ...]}
+_span_durations = defaultdict(list)
+# Счётчики: {имя счётчика: значение}
+_counters = Counter()
+# Отрезки и счётчики пополняются из потоков пула обработки запросов, поэтому изменяются только под блокировкой
+_stats_lock = threading.Lock()
+_cpu_profiler = None
+
+
+class _NullSpan:
+    """
+    Пустой контекстный менеджер, который возвращается из span() при выключенном сборе статистики
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def enable_stats(enabled: bool = True):
+    """
+    Включает (выключает) сбор статистики времени выполнения этапов и счётчиков
+    :param enabled: True для включения сбора статистики
+    """
+    global _stats_enabled
+    _stats_enabled = enabled
+
+
+def stats_enabled() -> bool:
+    return _stats_enabled
+
+
+def reset_stats():
+    """
+    Сбрасывает накопленные длительности этапов и счётчики
+    """
+    with _stats_lock:
+        _span_durations.clear()
+        _counters.clear()
+
+
+@contextmanager
+def _timed_span(name: str):
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start_time
+        with _stats_lock:
+            _span_durations[name].append(duration)
+
+
+def span(name: str):
+    """
+    Контекстный менеджер, замеряющий время выполнения именованного этапа монотонным таймером.
+    Пример: with span("vectorize"): ...
+    :param name: Имя этапа. Вложенные этапы принято именовать через точку: "lemmatize.segment"
+    :return: Контекстный менеджер. При выключенном сборе статистики - пустой
+    """
+    if not _stats_enabled:
+        return _NULL_SPAN
+    return _timed_span(name)
+
+
+def increment(name: str, value: int = 1):
+    """
+    Увеличивает значение именованного счётчика (число токенов, просмотренных записей
+    инвертированного индекса и т.д.)
+    :param name: Имя счётчика
+    :param value: Величина, на которую увеличивается счётчик
+    """
+    if _stats_enabled:
+        with _stats_lock:
+            _counters[name] += value
+
+
+def merge_stats(span_durations: Dict[str, List[float]], counters: Dict[str, int]):
+    """
+    Добавляет к накопленной статистике статистику, собранную в другом процессе
+    :param span_durations: Длительности отрезков в формате get_span_durations
+    :param counters: Счётчики в формате get_counters
+    """
+    with _stats_lock:
+        for name, durations in span_durations.items():
+            _span_durations[name].extend(durations)
+        _counters.update(counters)
+
+
+def get_span_durations() -> Dict[str, List[float]]:
+    """
+    :return: Копия длительностей отрезков, которую можно обходить, пока другие потоки пополняют статистику
+    """
+    with _stats_lock:
+        return {name: list(durations) for name, durations in _span_durations.items()}
+
+
+def get_counters() -> Dict[str, int]:
+    with _stats_lock:
+        return dict(_counters)
+
+
+def _percentile(sorted_values: List[float], fraction: float) -> float:
+    index = min(len(sorted_values) - 1, int(math.ceil(fraction * len(sorted_values))) - 1)
+    return sorted_values[max(index, 0)]
+
+
+def get_latency_histogram(durations: List[float]) -> Dict[float, int]:
+    """
+    Строит гистограмму задержек с корзинами, границы которых - степени двойки в миллисекундах
+    :param durations: Список длительностей в секундах
+    :return: Словарь {верхняя граница корзины в мс: число замеров в корзине}
+    """
+    histogram = Counter()
+    for duration in durations:
+        duration_ms = duration * 1000
+        bucket_power = max(math.ceil(math.log2(duration_ms)), -4) if duration_ms > 0 else -4
+        histogram[2.0 ** bucket_power] += 1
+    return dict(sorted(histogram.items()))
+
+
+def format_stats() -> str:
+    """
+    :return: Текстовый отчёт: для каждого этапа - число вызовов, суммарное и среднее время,
+    перцентили и гистограмма задержек; далее - значения всех счётчиков
+    """
+    span_durations = get_span_durations()
+    counters = get_counters()
+    lines = ["=== Этапы (мс) ==="]
+    for name in sorted(span_durations.keys()):
+        durations = sorted(span_durations[name])
+        total_ms = sum(durations) * 1000
+        lines.append(f"{name}: calls={len(durations)} total={total_ms:.3f} mean={total_ms / len(durations):.3f} "
+                     f"p50={_percentile(durations, 0.5) * 1000:.3f} p95={_percentile(durations, 0.95) * 1000:.3f} "
+                     f"max={durations[-1] * 1000:.3f}")
+        histogram = get_latency_histogram(durations)
+        lines.append("    " + " ".join(f"<={bound:g}ms:{count}" for bound, count in histogram.items()))
+    lines.append("=== Счётчики ===")
+    for name in sorted(counters.keys()):
+        lines.append(f"{name}: {counters[name]}")
+    return "\n".join(lines)
+
+
+def add_profiling_arguments(parser: ArgumentParser):
+    """
+    Добавляет в парсер аргументов командной строки общие для всех скриптов параметры
+    сбора статистики и профилирования
+    :param parser: Парсер аргументов командной строки
+    """
+    parser.add_argument('--stats', action="store_true",
+                        help="Собрать время выполнения этапов и счётчики и вывести их по завершении работы")
+    parser.add_argument('--profile_output_path', default=None, type=str,
+                        help="Если указан, программа выполняется под cProfile, а статистика профилировщика "
+                             "сохраняется в этот файл (читается модулем pstats)")
+    parser.add_argument('--trace_memory', action="store_true",
+                        help="Отслеживать выделения памяти модулем tracemalloc и вывести крупнейшие из них")
+
+
+def start_profiling(args: Namespace):
+    """
+    Включает сбор статистики и профилировщики согласно аргументам, добавленным add_profiling_arguments
+    :param args: Разобранные аргументы командной строки
+    """
+    global _cpu_profiler
+    enable_stats(args.stats)
+    if args.trace_memory:
+        tracemalloc.start()
+    if args.profile_output_path is not None:
+        _cpu_profiler = cProfile.Profile()
+        _cpu_profiler.enable()
+
+
+def finish_profiling(args: Namespace, num_memory_top_lines: int = 10):
+    """
+    Останавливает профилировщики, сохраняет результаты cProfile и выводит накопленную статистику
+    :param args: Разобранные аргументы командной строки
+    :param num_memory_top_lines: Число выводимых мест в коде с наибольшим объёмом выделенной памяти
+    """
+    global _cpu_profiler
+    if _cpu_profiler is not None:
+        _cpu_profiler.disable()
+        _cpu_profiler.dump_stats(args.profile_output_path)
+        pstats.Stats(_cpu_profiler).sort_stats("cumulative").print_stats(20)
+        _cpu_profiler = None
+    if args.trace_memory and tracemalloc.is_tracing():
+        snapshot = tracemalloc.take_snapshot()
+        current_size, peak_size = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"Память: текущая {current_size / 2 ** 20:.2f} MiB, пиковая {peak_size / 2 ** 20:.2f} MiB")
+        for statistic in snapshot.statistics("lineno")[:num_memory_top_lines]:
+            print(statistic)
+    if args.stats:
+        print(format_stats())
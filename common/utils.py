@@ -0,0 +1,24 @@
+import os
+from contextlib import contextmanager
+from typing import Iterator
+
+
+@contextmanager
+def replacing_file(path: str) -> Iterator[str]:
+    """
+    Контекстный менеджер для записи файла целиком: файл записывается рядом под временным именем
+    и после успешной записи атомарно подменяет path. Читатель (например, фоновая перезагрузка
+    индекса в task_5) никогда не видит недописанный файл.
+    Пример: with replacing_file(path) as temporary_path, codecs.open(temporary_path, 'w+') as f: ...
+    :param path: Путь к записываемому файлу
+    :return: Временный путь, по которому нужно записать файл
+    """
+    temporary_path = f"{path}.tmp"
+    try:
+        yield temporary_path
+    except BaseException:
+        # Недописанный временный файл не оставляем
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+    os.replace(temporary_path, path)
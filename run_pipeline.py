@@ -0,0 +1,529 @@
+import codecs
+import hashlib
+import json
+import math
+import os
+import subprocess
+import sys
+import threading
+from argparse import ArgumentParser
+from collections import Counter, defaultdict
+from queue import Queue
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from task_3.sharding import positive_int
+from common.utils import replacing_file
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+RAW_DOCUMENTS_DIR = "task_1/reviews/reviews"
+DOCUMENTS_INDEX_PATH = "task_1/reviews/index.txt"
+DICT_PATH = "task_2/tokenized_texts/dict.txt"
+DOCUMENTS_PATH = "task_2/tokenized_texts/documents.txt"
+KGRAM_INDEX_PATH = "task_2/tokenized_texts/kgram_index.txt"
+INV_INDEX_PATH = "task_3/inverted_index/inv_index.txt"
+DF_PATH = "task_4/tf_idf/df.txt"
+TF_IDF_PATH = "task_4/tf_idf/tf_idf.txt"
+SNAPSHOT_PATH = "task_5/index_snapshot/index.snapshot"
+VOCAB_PATH = "task_3/vocabulary/vocab.bin"
+LSA_INDEX_DIR = "task_5/lsa_index"
+INV_INDEX_SHARDS_PATH = "task_3/inverted_index/shards.txt"
+SNAPSHOT_SHARDS_PATH = "task_5/index_snapshot/shards.txt"
+# Параметры, общие для пакетного и потокового режимов
+ROOT_URL = "https://bookmix.ru"
+KGRAM_K = 3
+STATE_PATH = ".pipeline_state.json"
+# Имя этапа потокового режима в файле состояния конвейера
+STREAMING_STAGE_NAME = "streaming"
+
+
+class Stage(NamedTuple):
+    """
+    Этап конвейера: скрипт, запускаемый из корня репозитория с аргументами arguments.
+    Этап считается актуальным, если все его выходы существуют, а отпечаток входов и аргументов
+    совпадает с сохранённым после последнего успешного запуска
+    """
+    name: str
+    script_path: str
+    arguments: List[str]
+    inputs: List[str]
+    outputs: List[str]
+    dependencies: List[str]
+
+
+def get_pipeline_stages(num_reviews: int, num_shards: int = 1, lsa_num_components: int = 100,
+                        lsa_num_clusters: int = 0) -> List[Stage]:
+    """
+    :param num_reviews: Число скачиваемых отзывов
+    :param num_shards: Число шардов инвертированного индекса и слепка. При значении 1 шарды не строятся
+    :param lsa_num_components: Размерность латентного пространства LSA
+    :param lsa_num_clusters: Число кластеров IVF-индекса LSA. 0 - не строить IVF-индекс
+    :return: Этапы конвейера task_1 -> task_5. Выходами этапов перечислены все производные файлы,
+    поэтому после перестроения словаря (и смены номеров терминов) перестраиваются все зависящие от него индексы
+    """
+    from task_3.sharding import get_shard_path
+    from task_5.lsa_search import DOCUMENT_EMBEDDINGS_FNAME, TERM_PROJECTIONS_FNAME, VOCABULARY_FINGERPRINT_FNAME
+
+    stages = [
+        # Индекс коллекции записывается на уровень выше директории отзывов, чтобы не попасть в список документов
+        Stage(name="crawl", script_path="task_1/download_book_reviews.py",
+              arguments=["--root_url", ROOT_URL, "--num_reviews", str(num_reviews), "--save_dir", RAW_DOCUMENTS_DIR,
+                         "--index_fname", os.path.relpath(DOCUMENTS_INDEX_PATH, RAW_DOCUMENTS_DIR)],
+              inputs=[], outputs=[RAW_DOCUMENTS_DIR, DOCUMENTS_INDEX_PATH], dependencies=[]),
+        Stage(name="lemmatize", script_path="task_2/code/task_2.py",
+              arguments=["--input_data_dir", RAW_DOCUMENTS_DIR, "--output_dir", os.path.dirname(DICT_PATH),
+                         "--output_dict_fname", os.path.basename(DICT_PATH),
+                         "--output_documents_fname", os.path.basename(DOCUMENTS_PATH)],
+              inputs=[RAW_DOCUMENTS_DIR], outputs=[DICT_PATH, DOCUMENTS_PATH], dependencies=["crawl"]),
+        Stage(name="vocabulary", script_path="task_3/vocabulary.py",
+              arguments=["--input_dict_path", DICT_PATH, "--output_vocab_path", VOCAB_PATH],
+              inputs=[DICT_PATH], outputs=[VOCAB_PATH], dependencies=["lemmatize"]),
+        Stage(name="inverted_index", script_path="task_3/create_inverted_index.py",
+              arguments=["--input_documents_path", DOCUMENTS_PATH, "--input_dict_path", DICT_PATH,
+                         "--output_inv_index_path", INV_INDEX_PATH],
+              inputs=[DOCUMENTS_PATH, DICT_PATH], outputs=[INV_INDEX_PATH], dependencies=["lemmatize"]),
+        Stage(name="kgram_index", script_path="task_3/kgram_index.py",
+              arguments=["--input_dict_path", DICT_PATH, "--k", str(KGRAM_K),
+                         "--output_kgram_index_path", KGRAM_INDEX_PATH],
+              inputs=[DICT_PATH], outputs=[KGRAM_INDEX_PATH], dependencies=["lemmatize"]),
+        Stage(name="tf_idf", script_path="task_4/create_tf_idf_matrix.py",
+              arguments=["--input_documents_path", DOCUMENTS_PATH, "--input_dict_path", DICT_PATH,
+                         "--output_df_path", DF_PATH, "--output_tf_idf_path", TF_IDF_PATH],
+              inputs=[DOCUMENTS_PATH, DICT_PATH], outputs=[DF_PATH, TF_IDF_PATH], dependencies=["lemmatize"]),
+        Stage(name="snapshot", script_path="task_5/snapshot.py",
+              arguments=["--input_dict_path", DICT_PATH, "--input_df_path", DF_PATH, "--input_tf_idf_path", TF_IDF_PATH,
+                         "--input_documents_index", DOCUMENTS_INDEX_PATH,
+                         # Кэш лемм слов коллекции избавляет поиск от загрузки моделей Natasha
+                         "--input_raw_documents_dir", RAW_DOCUMENTS_DIR, "--output_snapshot_path", SNAPSHOT_PATH],
+              inputs=[DICT_PATH, DF_PATH, TF_IDF_PATH, DOCUMENTS_INDEX_PATH, RAW_DOCUMENTS_DIR],
+              outputs=[SNAPSHOT_PATH],
+              dependencies=["tf_idf"]),
+        Stage(name="lsa_index", script_path="task_5/lsa_search.py",
+              arguments=["--input_dict_path", DICT_PATH, "--input_tf_idf_path", TF_IDF_PATH,
+                         "--num_components", str(lsa_num_components), "--num_clusters", str(lsa_num_clusters),
+                         "--output_lsa_index_dir", LSA_INDEX_DIR],
+              inputs=[DICT_PATH, TF_IDF_PATH],
+              outputs=[os.path.join(LSA_INDEX_DIR, TERM_PROJECTIONS_FNAME),
+                       os.path.join(LSA_INDEX_DIR, DOCUMENT_EMBEDDINGS_FNAME),
+                       os.path.join(LSA_INDEX_DIR, VOCABULARY_FINGERPRINT_FNAME)],
+              dependencies=["tf_idf"]),
+    ]
+    if num_shards > 1:
+        stages.extend([
+            Stage(name="inverted_index_shards", script_path="task_3/create_inverted_index.py",
+                  arguments=["--input_documents_path", DOCUMENTS_PATH, "--input_dict_path", DICT_PATH,
+                             "--output_inv_index_path", INV_INDEX_PATH, "--num_shards", str(num_shards),
+                             "--output_shards_path", INV_INDEX_SHARDS_PATH],
+                  inputs=[DOCUMENTS_PATH, DICT_PATH],
+                  outputs=[INV_INDEX_SHARDS_PATH] + [get_shard_path(INV_INDEX_PATH, shard_id)
+                                                     for shard_id in range(num_shards)],
+                  dependencies=["lemmatize"]),
+            Stage(name="snapshot_shards", script_path="task_5/snapshot.py",
+                  arguments=["--input_dict_path", DICT_PATH, "--input_df_path", DF_PATH,
+                             "--input_tf_idf_path", TF_IDF_PATH, "--input_documents_index", DOCUMENTS_INDEX_PATH,
+                             "--input_raw_documents_dir", RAW_DOCUMENTS_DIR, "--output_snapshot_path", SNAPSHOT_PATH,
+                             "--num_shards", str(num_shards), "--output_shards_path", SNAPSHOT_SHARDS_PATH],
+                  inputs=[DICT_PATH, DF_PATH, TF_IDF_PATH, DOCUMENTS_INDEX_PATH, RAW_DOCUMENTS_DIR],
+                  outputs=[SNAPSHOT_SHARDS_PATH] + [get_shard_path(SNAPSHOT_PATH, shard_id)
+                                                    for shard_id in range(num_shards)],
+                  dependencies=["tf_idf"]),
+        ])
+    return stages
+
+
+def sort_stages_topologically(stages: List[Stage]) -> List[Stage]:
+    """
+    :param stages: Этапы конвейера
+    :return: Этапы в таком порядке, что каждый этап идёт после всех этапов, от которых он зависит
+    """
+    name2stage = {stage.name: stage for stage in stages}
+    num_unfinished_dependencies = {stage.name: len(stage.dependencies) for stage in stages}
+    dependent_stages = defaultdict(list)
+    for stage in stages:
+        for dependency in stage.dependencies:
+            dependent_stages[dependency].append(stage.name)
+    ready_stage_names = [stage.name for stage in stages if not stage.dependencies]
+    sorted_stages = []
+    while ready_stage_names:
+        stage_name = ready_stage_names.pop(0)
+        sorted_stages.append(name2stage[stage_name])
+        for dependent_stage_name in dependent_stages[stage_name]:
+            num_unfinished_dependencies[dependent_stage_name] -= 1
+            if num_unfinished_dependencies[dependent_stage_name] == 0:
+                ready_stage_names.append(dependent_stage_name)
+    if len(sorted_stages) != len(stages):
+        raise ValueError("Pipeline stages dependencies contain a cycle")
+    return sorted_stages
+
+
+def select_stages(stages: List[Stage], target_stage_names: List[str]) -> List[Stage]:
+    """
+    :param stages: Все этапы конвейера
+    :param target_stage_names: Имена этапов, которые нужно выполнить
+    :return: Указанные этапы и все этапы, от которых они (транзитивно) зависят
+    """
+    name2stage = {stage.name: stage for stage in stages}
+    selected_stage_names = set()
+    stage_names_to_visit = list(target_stage_names)
+    while stage_names_to_visit:
+        stage_name = stage_names_to_visit.pop()
+        if stage_name not in name2stage:
+            raise ValueError(f"Unknown pipeline stage: {stage_name}")
+        if stage_name not in selected_stage_names:
+            selected_stage_names.add(stage_name)
+            stage_names_to_visit.extend(name2stage[stage_name].dependencies)
+    return [stage for stage in stages if stage.name in selected_stage_names]
+
+
+def detach_stages(stages: List[Stage], stage_names: List[str]) -> List[Stage]:
+    """
+    :param stages: Все этапы конвейера
+    :param stage_names: Имена этапов, которые нужно выполнить без этапов, от которых они зависят
+    :return: Указанные этапы без зависимостей от невыбранных этапов. Входы невыбранных этапов
+    должны быть построены заранее
+    """
+    return [stage._replace(dependencies=[dependency for dependency in stage.dependencies
+                                         if dependency in stage_names])
+            for stage in stages if stage.name in stage_names]
+
+
+def _iter_files(path: str) -> Iterator[str]:
+    if os.path.isdir(path):
+        for dir_path, _, fnames in sorted(os.walk(path)):
+            for fname in sorted(fnames):
+                yield os.path.join(dir_path, fname)
+    elif os.path.exists(path):
+        yield path
+
+
+def get_fingerprint(paths: List[str], arguments: List[str], check_mode: str) -> str:
+    """
+    :param paths: Пути ко входным файлам и директориям этапа относительно корня репозитория
+    :param arguments: Аргументы скрипта этапа
+    :param check_mode: mtime - отпечаток по размерам и времени изменения файлов, hash - по их содержимому
+    :return: Отпечаток входов этапа
+    """
+    fingerprint = hashlib.sha256(json.dumps(arguments).encode("utf-8"))
+    for path in paths:
+        for file_path in _iter_files(os.path.join(ROOT_DIR, path)):
+            fingerprint.update(os.path.relpath(file_path, ROOT_DIR).encode("utf-8"))
+            if check_mode == "hash":
+                with open(file_path, "rb") as input_file:
+                    for chunk in iter(lambda: input_file.read(1 << 20), b""):
+                        fingerprint.update(chunk)
+            else:
+                file_stat = os.stat(file_path)
+                fingerprint.update(f"{file_stat.st_size}:{file_stat.st_mtime_ns}".encode("utf-8"))
+    return fingerprint.hexdigest()
+
+
+def load_pipeline_state(state_path: str) -> Dict[str, Dict[str, str]]:
+    """
+    :param state_path: Путь к файлу состояния конвейера
+    :return: Словарь {способ проверки : {имя этапа : отпечаток входов после последнего успешного запуска}}
+    """
+    if not os.path.exists(state_path):
+        return {}
+    with codecs.open(state_path, 'r', encoding="utf-8") as state_file:
+        return json.load(state_file)
+
+
+def save_pipeline_state(state_path: str, state: Dict[str, Dict[str, str]]):
+    with replacing_file(state_path) as temporary_path, \
+            codecs.open(temporary_path, 'w+', encoding="utf-8") as state_file:
+        json.dump(state, state_file, indent=2, sort_keys=True)
+
+
+def _get_mtimes(paths: List[str]) -> List[float]:
+    return [os.stat(file_path).st_mtime for path in paths for file_path in _iter_files(os.path.join(ROOT_DIR, path))]
+
+
+def is_stage_up_to_date(stage: Stage, fingerprint: str, saved_fingerprint: Optional[str]) -> bool:
+    """
+    :param stage: Этап конвейера
+    :param fingerprint: Текущий отпечаток входов этапа
+    :param saved_fingerprint: Отпечаток входов после последнего успешного запуска этапа или None,
+    если этап ещё не запускался конвейером
+    :return: True, если этап можно пропустить
+    """
+    if not all(os.path.exists(os.path.join(ROOT_DIR, output_path)) for output_path in stage.outputs):
+        return False
+    if saved_fingerprint is not None:
+        return saved_fingerprint == fingerprint
+    # Выходы, построенные без конвейера, актуальны, если они новее всех входов (как в make)
+    input_mtimes, output_mtimes = _get_mtimes(stage.inputs), _get_mtimes(stage.outputs)
+    return not input_mtimes or not output_mtimes or max(input_mtimes) <= min(output_mtimes)
+
+
+def run_stages(stages: List[Stage], state_path: str, check_mode: str, force: bool):
+    """
+    Выполняет этапы конвейера в порядке зависимостей, пропуская актуальные этапы
+    :param stages: Этапы конвейера
+    :param state_path: Путь к файлу состояния конвейера
+    :param check_mode: Способ проверки изменения входов: mtime или hash
+    :param force: True для выполнения всех этапов независимо от их актуальности
+    """
+    state = load_pipeline_state(state_path)
+    fingerprints = state.setdefault(check_mode, {})
+    environment = dict(os.environ)
+    environment["PYTHONPATH"] = os.pathsep.join(filter(None, (ROOT_DIR, environment.get("PYTHONPATH"))))
+    for stage in sort_stages_topologically(stages):
+        fingerprint = get_fingerprint(stage.inputs, stage.arguments, check_mode)
+        if not force and is_stage_up_to_date(stage, fingerprint, fingerprints.get(stage.name)):
+            print(f"[{stage.name}] up to date, skipped")
+            if fingerprints.get(stage.name) != fingerprint:
+                fingerprints[stage.name] = fingerprint
+                save_pipeline_state(state_path, state)
+            continue
+        print(f"[{stage.name}] running {stage.script_path}")
+        subprocess.run([sys.executable, os.path.join(ROOT_DIR, stage.script_path)] + stage.arguments,
+                       cwd=ROOT_DIR, env=environment, check=True)
+        fingerprints[stage.name] = fingerprint
+        save_pipeline_state(state_path, state)
+
+
+def prefetch(iterable: Iterable, max_queue_size: int) -> Iterator:
+    """
+    Выполняет итерацию по iterable в отдельном потоке, складывая элементы в очередь ограниченного
+    размера. Пока потребитель обрабатывает элемент, следующие элементы уже читаются (скачиваются)
+    :param iterable: Источник элементов
+    :param max_queue_size: Максимальное число прочитанных, но ещё не обработанных элементов
+    :return: Генератор элементов iterable в исходном порядке
+    """
+    queue = Queue(maxsize=max_queue_size)
+    end_of_stream = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                queue.put((item, None))
+        except Exception as exception:
+            queue.put((end_of_stream, exception))
+            return
+        queue.put((end_of_stream, None))
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item, exception = queue.get()
+        if exception is not None:
+            raise exception
+        if item is end_of_stream:
+            return
+        yield item
+
+
+def iter_raw_documents(raw_documents_dir: str) -> Iterator[str]:
+    """
+    :param raw_documents_dir: Директория непредобработанных документов
+    :return: Генератор текстов документов в порядке их номеров
+    """
+    from task_2.code.task_2 import get_doc_id_word_key
+
+    for document_fname in sorted(os.listdir(raw_documents_dir), key=get_doc_id_word_key):
+        with codecs.open(os.path.join(raw_documents_dir, document_fname), 'r', encoding="utf-8") as review_file:
+            yield review_file.read()
+
+
+def iter_crawled_documents(num_reviews: int, raw_documents_dir: str, documents_index_path: str) -> Iterator[str]:
+    """
+    Скачивает отзывы и по мере скачивания записывает их в директорию непредобработанных документов и индекс коллекции
+    :param num_reviews: Число скачиваемых отзывов
+    :param raw_documents_dir: Директория непредобработанных документов
+    :param documents_index_path: Путь к индекс-файлу коллекции
+    :return: Генератор текстов документов в порядке их номеров
+    """
+    import requests
+    from task_1.download_book_reviews import find_review_urls, iter_review_texts_by_url
+
+    if not os.path.exists(raw_documents_dir):
+        os.makedirs(raw_documents_dir)
+    session = requests.session()
+    review_urls = find_review_urls(session, num_reviews)
+    with replacing_file(documents_index_path) as temporary_path, \
+            codecs.open(temporary_path, 'w+', encoding="utf-8") as index_file:
+        for doc_id, (review_url, text) in enumerate(iter_review_texts_by_url(review_urls, session, ROOT_URL)):
+            with codecs.open(os.path.join(raw_documents_dir, f"review_{doc_id}.txt"), 'w+',
+                             encoding="utf-8") as text_file:
+                text_file.write(f"{text.strip()}\n")
+            index_file.write(f"{doc_id}\t{review_url.strip()}\n")
+            yield text
+
+
+def accumulate_index(lemmatized_documents: Iterable[List[Tuple[str, str]]]) -> tuple:
+    """
+    За один проход по лемматизированным документам строит словарь, инвертированный индекс,
+    матрицу TF, вектор DF и кэш лемм слов
+    :param lemmatized_documents: Документы в виде списков пар (слово, лемма)
+    :return: token2id, инвертированный индекс (список списков номеров документов), разреженная
+    матрица TF, Counter документных частот и словарь {слово в нижнем регистре : самая частая лемма}
+    """
+    from scipy.sparse import csr_matrix
+
+    token2id = {}
+    inverted_index = []
+    documents_frequencies = Counter()
+    word_lemma_counters = defaultdict(Counter)
+    row_indices, col_indices, frequency_values = [], [], []
+    num_documents = 0
+    for doc_id, token_lemma_pairs in enumerate(lemmatized_documents):
+        token_ids_list = []
+        for word, lemma in token_lemma_pairs:
+            token_id = token2id.setdefault(lemma, len(token2id))
+            if token_id == len(inverted_index):
+                inverted_index.append([])
+            token_ids_list.append(token_id)
+            word_lemma_counters[word.lower()][lemma] += 1
+        token_id_frequencies = Counter(token_ids_list)
+        documents_frequencies.update(token_id_frequencies.keys())
+        for token_id, frequency in token_id_frequencies.items():
+            inverted_index[token_id].append(doc_id)
+            row_indices.append(doc_id)
+            col_indices.append(token_id)
+            frequency_values.append(frequency)
+        num_documents += 1
+    term_frequencies_sparse_matrix = csr_matrix((frequency_values, (row_indices, col_indices)),
+                                                shape=(num_documents, len(token2id)))
+    lemma_cache = {word: lemma_counter.most_common(1)[0][0] for word, lemma_counter in word_lemma_counters.items()}
+    return token2id, inverted_index, term_frequencies_sparse_matrix, documents_frequencies, lemma_cache
+
+
+def run_streaming(args, state_path: str):
+    """
+    Потоковый режим: документы проходят путь скачивание (или чтение) -> лемматизация -> накопление
+    индексов через генераторы и очередь ограниченного размера, без промежуточного файла
+    лемматизированных документов. Записываются только итоговые словарь, инвертированный индекс
+    (и его шарды), DF, TF-IDF, k-граммный индекс и слепок индекса (с кэшем лемм). Остальные производные
+    индексы (компактный словарь, LSA, шарды слепка) затем строятся соответствующими этапами конвейера
+    """
+    from task_2.code.task_2 import get_token_lemma_pairs, load_natasha_models
+    from task_3.create_inverted_index import save_inverted_index
+    from task_3.kgram_index import build_kgram_index, save_kgram_index
+    from task_3.sharding import get_shard_document_ranges, get_shard_path, save_shards_meta
+    from task_4.create_tf_idf_matrix import calculate_sparse_tf_idf_matrix, save_df_matrix, save_tf_idf_matrix
+    from task_5.snapshot import build_index_snapshot, save_index_snapshot
+    from task_5.utils import load_doc_id_url_mapping_from_index
+
+    def root_path(path):
+        return os.path.join(ROOT_DIR, path)
+
+    outputs = [DICT_PATH, KGRAM_INDEX_PATH, INV_INDEX_PATH, DF_PATH, TF_IDF_PATH, SNAPSHOT_PATH]
+    if args.num_shards > 1:
+        outputs.append(INV_INDEX_SHARDS_PATH)
+    all_stages = get_pipeline_stages(args.num_reviews, num_shards=args.num_shards,
+                                     lsa_num_components=args.lsa_num_components,
+                                     lsa_num_clusters=args.lsa_num_clusters)
+    # Этапы, которые строятся по выходам потокового режима, а не по лемматизированным документам
+    downstream_stages = detach_stages(all_stages, ["vocabulary", "lsa_index", "snapshot_shards"])
+    inputs = [] if args.crawl else [RAW_DOCUMENTS_DIR, DOCUMENTS_INDEX_PATH]
+    state = load_pipeline_state(state_path)
+    fingerprints = state.setdefault(args.check, {})
+    fingerprint = get_fingerprint(inputs, ["--streaming"], args.check)
+    streaming_stage = Stage(name=STREAMING_STAGE_NAME, script_path=__file__, arguments=["--streaming"], inputs=inputs,
+                            outputs=outputs, dependencies=[])
+    # Без сохранённого отпечатка потоковый режим выполняется всегда: выходы могли быть построены по другим документам
+    saved_fingerprint = fingerprints.get(STREAMING_STAGE_NAME)
+    if not args.force and not args.crawl and saved_fingerprint is not None and \
+            is_stage_up_to_date(streaming_stage, fingerprint, saved_fingerprint):
+        print(f"[{STREAMING_STAGE_NAME}] up to date, skipped")
+        run_stages(downstream_stages, state_path=state_path, check_mode=args.check, force=False)
+        return
+    for output_path in outputs:
+        output_dir = os.path.dirname(root_path(output_path))
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+
+    if args.crawl:
+        raw_texts = iter_crawled_documents(args.num_reviews, root_path(RAW_DOCUMENTS_DIR),
+                                           root_path(DOCUMENTS_INDEX_PATH))
+    else:
+        raw_texts = iter_raw_documents(root_path(RAW_DOCUMENTS_DIR))
+    segmenter, morph_tagger, morph_vocab = load_natasha_models()
+    lemmatized_documents = (get_token_lemma_pairs(raw_text=raw_text, segmenter=segmenter, morph_tagger=morph_tagger,
+                                                  morph_vocab=morph_vocab)
+                            for raw_text in prefetch(raw_texts, max_queue_size=args.max_queue_size))
+    token2id, inverted_index, term_frequencies_sparse_matrix, documents_frequencies, lemma_cache = \
+        accumulate_index(lemmatized_documents)
+
+    id2token = [None] * len(token2id)
+    for token, token_id in token2id.items():
+        id2token[token_id] = token
+    with replacing_file(root_path(DICT_PATH)) as temporary_path, \
+            codecs.open(temporary_path, 'w+', encoding="utf-8") as dict_file:
+        for token in id2token:
+            dict_file.write(f"{token}\n")
+    save_kgram_index(root_path(KGRAM_INDEX_PATH), build_kgram_index(token2id, k=KGRAM_K))
+    save_inverted_index(root_path(INV_INDEX_PATH), inverted_index)
+    if args.num_shards > 1:
+        document_ranges = get_shard_document_ranges(term_frequencies_sparse_matrix.shape[0], args.num_shards)
+        shard_paths = [root_path(get_shard_path(INV_INDEX_PATH, shard_id)) for shard_id in range(args.num_shards)]
+        for shard_path, (first_doc_id, shard_num_documents) in zip(shard_paths, document_ranges):
+            # Номера документов в списках возрастают, поэтому документы шарда - непрерывный отрезок списка
+            save_inverted_index(shard_path, [[doc_id - first_doc_id for doc_id in doc_ids
+                                              if first_doc_id <= doc_id < first_doc_id + shard_num_documents]
+                                             for doc_ids in inverted_index])
+        save_shards_meta(root_path(INV_INDEX_SHARDS_PATH), shard_paths=shard_paths, document_ranges=document_ranges)
+    tf_idf_sparse_matrix = calculate_sparse_tf_idf_matrix(term_frequencies_sparse_matrix, documents_frequencies)
+    save_df_matrix(save_path=root_path(DF_PATH), df=documents_frequencies, id2token=id2token)
+    save_tf_idf_matrix(save_path=root_path(TF_IDF_PATH), df_vector=documents_frequencies,
+                       tf_idf_sparse_matrix=tf_idf_sparse_matrix, id2token=id2token)
+    num_documents = term_frequencies_sparse_matrix.shape[0]
+    token_idfs = {token_id: math.log2(num_documents / document_frequency)
+                  for token_id, document_frequency in documents_frequencies.items()}
+    snapshot = build_index_snapshot(token2id=token2id, token_idfs=token_idfs, tf_idf_matrix=tf_idf_sparse_matrix,
+                                    doc_id2url=load_doc_id_url_mapping_from_index(root_path(DOCUMENTS_INDEX_PATH)),
+                                    lemma_cache=lemma_cache)
+    save_index_snapshot(root_path(SNAPSHOT_PATH), snapshot)
+
+    # После скачивания отпечаток считается по только что записанным документам
+    fingerprints[STREAMING_STAGE_NAME] = get_fingerprint([RAW_DOCUMENTS_DIR, DOCUMENTS_INDEX_PATH], ["--streaming"],
+                                                         args.check)
+    save_pipeline_state(state_path, state)
+    run_stages(downstream_stages, state_path=state_path, check_mode=args.check, force=False)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--stages', nargs='*', default=None, type=str,
+                        help="Имена выполняемых этапов: crawl, lemmatize, vocabulary, inverted_index, kgram_index, "
+                             "tf_idf, snapshot, lsa_index, а при num_shards больше 1 - inverted_index_shards и "
+                             "snapshot_shards. Этапы, от которых они зависят, добавляются автоматически. "
+                             "По умолчанию выполняются все этапы")
+    parser.add_argument('--force', action="store_true",
+                        help="Выполнить этапы, даже если их входы не изменились с последнего запуска")
+    parser.add_argument('--check', default="mtime", choices=("mtime", "hash"), type=str,
+                        help="Способ проверки изменения входов этапа: по размеру и времени изменения "
+                             "файлов или по их содержимому")
+    parser.add_argument('--streaming', action="store_true",
+                        help="Потоковый режим: все этапы выполняются в одном процессе за один проход по "
+                             "документам, без промежуточного файла лемматизированных документов")
+    parser.add_argument('--crawl', action="store_true",
+                        help="В потоковом режиме скачать коллекцию заново вместо чтения уже скачанных документов")
+    parser.add_argument('--num_reviews', default=150, type=int, help="Число скачиваемых отзывов")
+    parser.add_argument('--num_shards', default=1, type=positive_int,
+                        help="Число шардов инвертированного индекса и слепка. При значении 1 шарды не строятся")
+    parser.add_argument('--lsa_num_components', default=100, type=int,
+                        help="Размерность латентного пространства индекса LSA")
+    parser.add_argument('--lsa_num_clusters', default=0, type=int,
+                        help="Число кластеров IVF-индекса LSA. 0 - не строить IVF-индекс")
+    parser.add_argument('--max_queue_size', default=16, type=int,
+                        help="Размер очереди между чтением (скачиванием) и лемматизацией документов "
+                             "в потоковом режиме")
+    parser.add_argument('--state_path', default=STATE_PATH, type=str,
+                        help="Путь к файлу состояния конвейера относительно корня репозитория")
+    args = parser.parse_args()
+    state_path = os.path.join(ROOT_DIR, args.state_path)
+
+    if ROOT_DIR not in sys.path:
+        sys.path.insert(0, ROOT_DIR)
+    if args.streaming:
+        run_streaming(args, state_path)
+        return
+    stages = get_pipeline_stages(args.num_reviews, num_shards=args.num_shards,
+                                 lsa_num_components=args.lsa_num_components, lsa_num_clusters=args.lsa_num_clusters)
+    if args.stages:
+        stages = select_stages(stages, args.stages)
+    run_stages(stages, state_path=state_path, check_mode=args.check, force=args.force)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,74 @@
 import codecs
 import os
+import threading
 from argparse import ArgumentParser
-from typing import List
+from functools import lru_cache
+from typing import List, Tuple, TYPE_CHECKING
 
-from natasha import (
-    Segmenter,
-    MorphVocab,
-    NewsMorphTagger,
-    NewsEmbedding,
-    Doc
-)
+from common.profiling import add_profiling_arguments, finish_profiling, increment, span, start_profiling
+from common.utils import replacing_file
 
+if TYPE_CHECKING:
+    from natasha import Segmenter, MorphVocab, NewsMorphTagger
 
-def get_lemmatized_doc(raw_text: str, segmenter: Segmenter, morph_tagger: NewsMorphTagger,
-                       morph_vocab: MorphVocab) -> List[str]:
+
+# Модели создаются один раз, даже если их одновременно запросили несколько потоков
+_natasha_models_lock = threading.Lock()
+
+
+def load_natasha_models() -> Tuple["Segmenter", "NewsMorphTagger", "MorphVocab"]:
+    """
+    Создаёт модели библиотеки Natasha при первом обращении и переиспользует их при последующих.
+    Импорт natasha и загрузка эмбеддингов занимают несколько секунд, поэтому они откладываются
+    до момента, когда лемматизатор действительно понадобится
+    :return: Токенизатор, морфологический парсер и лемматизатор библиотеки Natasha
+    """
+    with _natasha_models_lock:
+        return _create_natasha_models()
+
+
+@lru_cache(maxsize=None)
+def _create_natasha_models() -> Tuple["Segmenter", "NewsMorphTagger", "MorphVocab"]:
+    with span("load.natasha_models"):
+        from natasha import Segmenter, MorphVocab, NewsMorphTagger, NewsEmbedding
+        segmenter = Segmenter()
+        morph_vocab = MorphVocab()
+        emb = NewsEmbedding()
+        morph_tagger = NewsMorphTagger(emb)
+    return segmenter, morph_tagger, morph_vocab
+
+
+def get_token_lemma_pairs(raw_text: str, segmenter: "Segmenter", morph_tagger: "NewsMorphTagger",
+                          morph_vocab: "MorphVocab") -> List[Tuple[str, str]]:
+    """
+    :param raw_text: Строка, состоящая из тексте непредобработанного документа
+    :param segmenter: токенизатор библиотеки Natasha
+    :param morph_tagger: Морфологический парсер библиотеки Natasha
+    :param morph_vocab: Лемматизатор библиотеки Natasha
+    :return: Список пар (слово в исходном тексте, его лемма) с отброшенными знаками пунктуации
+    """
+    from natasha import Doc
+
+    token_lemma_pairs = []
+    natasha_doc = Doc(raw_text)
+    # токенизация
+    with span("lemmatize.segment"):
+        natasha_doc.segment(segmenter)
+    # морфологический парсинг
+    with span("lemmatize.tag_morph"):
+        natasha_doc.tag_morph(morph_tagger)
+    with span("lemmatize.lemmatize"):
+        for token in natasha_doc.tokens:
+            # лемматизация токенов
+            token.lemmatize(morph_vocab)
+            if token.pos != "PUNCT":
+                token_lemma_pairs.append((token.text, token.lemma))
+    increment("tokens", len(natasha_doc.tokens))
+    return token_lemma_pairs
+
+
+def get_lemmatized_doc(raw_text: str, segmenter: "Segmenter", morph_tagger: "NewsMorphTagger",
+                       morph_vocab: "MorphVocab") -> List[str]:
     """
     :param raw_text: Строка, состоящая из тексте непредобработанного документа
     :param segmenter: токенизатор библиотеки Natasha
@@ -23,17 +78,9 @@ def get_lemmatized_doc(raw_text: str, segmenter: Segmenter, morph_tagger: NewsMo
     :param morph_vocab: Лемматизатор библиотеки Natasha
     :return: Список лемм слов исходного текста с отброшенными знаками пунктуации
     """
-    lemmatized_tokens = []
-    natasha_doc = Doc(raw_text)
-    # токенизация
-    natasha_doc.segment(segmenter)
-    # морфологический парсинг
-    natasha_doc.tag_morph(morph_tagger)
-    for token in natasha_doc.tokens:
-        # лемматизация токенов
-        token.lemmatize(morph_vocab)
-        if token.pos != "PUNCT":
-            lemmatized_tokens.append(token.lemma)
+    token_lemma_pairs = get_token_lemma_pairs(raw_text=raw_text, segmenter=segmenter, morph_tagger=morph_tagger,
+                                              morph_vocab=morph_vocab)
+    lemmatized_tokens = [lemma for _, lemma in token_lemma_pairs]
     return lemmatized_tokens
 
 
@@ -56,7 +103,9 @@ def main():
                         help="имя файла словаря")
     parser.add_argument('--output_documents_fname', default=r"documents.txt", type=str,
                         help="Имя файла с лемматизированными документами")
+    add_profiling_arguments(parser)
     args = parser.parse_args()
+    start_profiling(args)
 
     input_data_dir = args.input_data_dir
 
@@ -68,10 +117,7 @@ def main():
     output_dict_path = os.path.join(output_dir, output_dict_fname)
     output_documents_path = os.path.join(output_dir, output_documents_fname)
 
-    segmenter = Segmenter()
-    morph_vocab = MorphVocab()
-    emb = NewsEmbedding()
-    morph_tagger = NewsMorphTagger(emb)
+    segmenter, morph_tagger, morph_vocab = load_natasha_models()
     # список списков лемм всех документов
     lemmatized_tokens_lists = []
     # словарь лемм
@@ -88,13 +134,15 @@ def main():
             # обновляем словарь лемм
             lemmas_dictionary.update(lemmatized_tokens)
     # запись словаря в файл
-    with codecs.open(output_dict_path, 'w+', encoding="utf-8") as dict_file:
+    with replacing_file(output_dict_path) as temporary_path, \
+            codecs.open(temporary_path, 'w+', encoding="utf-8") as dict_file:
         for token in lemmas_dictionary:
             dict_file.write(f"{token}\n")
     # Запись лемматизированных документов в файл
     with codecs.open(output_documents_path, 'w+', encoding="utf-8") as documents_file:
         for doc_lemmas_list in lemmatized_tokens_lists:
             documents_file.write(f"{' '.join(doc_lemmas_list)}\n")
+    finish_profiling(args)
 
 
 if __name__ == '__main__':
@@ -1,7 +1,16 @@
 from argparse import ArgumentParser
-from typing import List, Set, Dict
+from multiprocessing.pool import Pool
+from typing import List, Optional, Set, Dict
 
-from task_3.utils import load_dict, load_inverted_index_from_file
+from task_3.kgram_index import KGramIndex, find_closest_term_id, load_kgram_index
+from common.profiling import add_profiling_arguments, finish_profiling, increment, span, start_profiling
+from task_3.sharding import load_shards_meta, scatter_gather, start_shard_workers, stop_shard_workers
+from task_3.utils import load_inverted_index_from_file
+from task_3.vocabulary import WILDCARD, expand_term_pattern, load_vocabulary
+
+# Состояние процесса-обработчика шарда: словарь, инвертированный индекс шарда, k-граммный индекс
+# словаря, номер первого документа шарда и число документов шарда
+_shard_state = {}
 
 
 def find_documents_in_index_by_word(word_id: int, inverted_index: List[Set[int]], num_documents: int,
@@ -23,6 +32,29 @@ def find_documents_in_index_by_word(word_id: int, inverted_index: List[Set[int]]
     не содержится слово с идентификатором word_id
     """
     documents_list = inverted_index[word_id]
+    increment("postings_touched", len(documents_list))
+    if not get_present:
+        all_docs_set = set(range(num_documents))
+        documents_list = all_docs_set.difference(documents_list)
+    return documents_list
+
+
+def find_documents_in_index_by_words(word_ids: List[int], inverted_index: List[Set[int]], num_documents: int,
+                                     get_present: bool = False) -> Set[int]:
+    """
+    :param word_ids: Идентификаторы слов, например, всех слов, подходящих под шаблон запроса
+    :param inverted_index: Инвертированный индекс документов
+    :param num_documents: Число документов коллекции
+    :param get_present: True для взятия списка идентификаторов документов, в которых
+    содержится хотя бы одно из слов word_ids, иначе берётся дополнение этого списка до
+    всей коллекции
+    :return: Список уникальных номеров документов без повторений, в которых содержится
+    хотя бы одно из слов word_ids / не содержится ни одного из них
+    """
+    documents_list = set()
+    for word_id in word_ids:
+        documents_list.update(find_documents_in_index_by_word(word_id=word_id, inverted_index=inverted_index,
+                                                              num_documents=num_documents, get_present=True))
     if not get_present:
         all_docs_set = set(range(num_documents))
         documents_list = all_docs_set.difference(documents_list)
@@ -65,10 +97,14 @@ def get_request_intersection_units(request_string: str, ) -> List[List[str]]:
 
 
 def process_intersection_subrequest(intersection_tokens_strings: List[str], inverted_index: List[Set[int]],
-                                    token2id: Dict[str, int], num_documents: int) -> Set[int]:
+                                    token2id: Dict[str, int], num_documents: int,
+                                    kgram_index: Optional[KGramIndex] = None) -> Set[int]:
     """
     Получает список слов и возвращает номера документов, в которых эти слова (не)встречаются
-    совместно. Для случая непоявления слова в документе перед ним ставится символ '~'
+    совместно. Для случая непоявления слова в документе перед ним ставится символ '~'.
+    Слово может быть шаблоном с символом '*', заменяющим любую последовательность символов.
+    Слово вне словаря заменяется ближайшим к нему словом словаря, если передан k-граммный индекс,
+    иначе считается, что оно не встречается ни в одном документе
     :param intersection_tokens_strings: Список строк - слов, от которых требуется одновременное
     (не)присутствие в документах
     :param inverted_index: Инвертированный индекс документов: список из <размер словаря>
@@ -76,6 +112,7 @@ def process_intersection_subrequest(intersection_tokens_strings: List[str], inve
     слово
     :param token2id: Словарь {слово : номер его позиции в словаре}
     :param num_documents: Число документов в коллекции.
+    :param kgram_index: k-граммный индекс словаря для исправления слов вне словаря
     :return: Набор уникальных идентификаторов документов, удовлетворяющих строке запроса на
     одновременное (не)присутствие в документе.
     """
@@ -86,9 +123,22 @@ def process_intersection_subrequest(intersection_tokens_strings: List[str], inve
             token = token.strip('~')
         else:
             present_flag = True
-        token_id = token2id[token]
-        token_doc_ids = find_documents_in_index_by_word(word_id=token_id, inverted_index=inverted_index,
-                                                        num_documents=num_documents, get_present=present_flag)
+        token_id = None if WILDCARD in token else token2id.get(token)
+        if WILDCARD in token:
+            # Шаблон вида 'книг*' заменяется объединением списков документов всех подходящих слов
+            token_ids = expand_term_pattern(token2id, token)
+            increment("wildcard_expanded_terms", len(token_ids))
+            token_doc_ids = find_documents_in_index_by_words(word_ids=token_ids, inverted_index=inverted_index,
+                                                             num_documents=num_documents, get_present=present_flag)
+        elif token_id is not None:
+            token_doc_ids = find_documents_in_index_by_word(word_id=token_id, inverted_index=inverted_index,
+                                                            num_documents=num_documents, get_present=present_flag)
+        else:
+            increment("query_terms_out_of_vocab")
+            closest_term_id = find_closest_term_id(kgram_index, token) if kgram_index is not None else None
+            token_ids = [closest_term_id] if closest_term_id is not None else []
+            token_doc_ids = find_documents_in_index_by_words(word_ids=token_ids, inverted_index=inverted_index,
+                                                             num_documents=num_documents, get_present=present_flag)
         intersection_doc_ids_list.append(token_doc_ids)
     doc_ids_intersection = combine_docs_sets(intersection_doc_ids_list, operation="intersection")
 
@@ -96,7 +146,7 @@ def process_intersection_subrequest(intersection_tokens_strings: List[str], inve
 
 
 def get_doc_ids_by_request(request_string: str, inverted_index: List[Set[int]], token2id: Dict[str, int],
-                           num_documents: int) -> Set[int]:
+                           num_documents: int, kgram_index: Optional[KGramIndex] = None) -> Set[int]:
     """
     Получает на вход строку запроса, соответствующую введенному мной языку запросов,
     возвращает список номеров документов, удовлетворяющих этому запросу.
@@ -104,15 +154,64 @@ def get_doc_ids_by_request(request_string: str, inverted_index: List[Set[int]],
     :param inverted_index: Инвертированный индекс документов
     :param token2id: Словарь инвертированного индекса
     :param num_documents: Общее число документов в коллекции
+    :param kgram_index: k-граммный индекс словаря для исправления слов вне словаря
     :return: Список уникальных номеров документов, удовлетворяющих полученному запросу
     """
-    intersection_strings_list = get_request_intersection_units(request_string)
-    union_units = []
-    for intersection_strs in intersection_strings_list:
-        doc_ids_intersection = process_intersection_subrequest(intersection_strs, inverted_index=inverted_index,
-                                                               token2id=token2id, num_documents=num_documents)
-        union_units.append(doc_ids_intersection)
-    united_doc_ids = combine_docs_sets(union_units, operation="union")
+    with span("boolean_search"):
+        intersection_strings_list = get_request_intersection_units(request_string)
+        union_units = []
+        for intersection_strs in intersection_strings_list:
+            doc_ids_intersection = process_intersection_subrequest(intersection_strs, inverted_index=inverted_index,
+                                                                   token2id=token2id, num_documents=num_documents,
+                                                                   kgram_index=kgram_index)
+            union_units.append(doc_ids_intersection)
+        united_doc_ids = combine_docs_sets(union_units, operation="union")
+    return united_doc_ids
+
+
+def init_boolean_shard_worker(dict_path: str, inv_index_path: str, first_doc_id: int, num_documents: int,
+                              kgram_index_path: Optional[str] = None):
+    """
+    Загружает шард инвертированного индекса в память процесса-обработчика шарда
+    :param dict_path: Путь к словарю
+    :param inv_index_path: Путь к файлу инвертированного индекса шарда
+    :param first_doc_id: Номер первого документа шарда в коллекции
+    :param num_documents: Число документов шарда
+    :param kgram_index_path: Путь к файлу k-граммного индекса словаря или None
+    """
+    _shard_state["token2id"] = load_vocabulary(dict_path)
+    _shard_state["kgram_index"] = None
+    if kgram_index_path is not None:
+        _shard_state["kgram_index"] = load_kgram_index(kgram_index_path, _shard_state["token2id"])
+    _shard_state["inverted_index"] = load_inverted_index_from_file(inv_index_path)
+    _shard_state["first_doc_id"] = first_doc_id
+    _shard_state["num_documents"] = num_documents
+
+
+def search_boolean_shard(request_string: str) -> Set[int]:
+    """
+    Выполняет поисковый запрос на шарде, загруженном init_boolean_shard_worker
+    :param request_string: Строка запроса
+    :return: Номера документов коллекции (не шарда), удовлетворяющих запросу
+    """
+    first_doc_id = _shard_state["first_doc_id"]
+    local_doc_ids = get_doc_ids_by_request(request_string, inverted_index=_shard_state["inverted_index"],
+                                           token2id=_shard_state["token2id"],
+                                           num_documents=_shard_state["num_documents"],
+                                           kgram_index=_shard_state["kgram_index"])
+    return {first_doc_id + doc_id for doc_id in local_doc_ids}
+
+
+def get_doc_ids_by_request_sharded(request_string: str, shard_pools: List[Pool]) -> Set[int]:
+    """
+    Рассылает поисковый запрос процессам-обработчикам всех шардов и объединяет их ответы
+    :param request_string: Строка запроса
+    :param shard_pools: Пулы процессов-обработчиков шардов, запущенные с инициализатором init_boolean_shard_worker
+    :return: Список уникальных номеров документов, удовлетворяющих полученному запросу
+    """
+    with span("boolean_search_sharded"):
+        shard_doc_ids = scatter_gather(shard_pools, search_boolean_shard, (request_string,))
+        united_doc_ids = combine_docs_sets(shard_doc_ids, operation="union")
     return united_doc_ids
 
 
@@ -121,29 +220,58 @@ def main():
     parser.add_argument('--input_inv_index_path', default=r"inverted_index/inv_index.txt", type=str,
                         help="Путь к файлу инвертированного индекса")
     parser.add_argument('--input_dict_path', default=r"../task_2/tokenized_texts/dict.txt", type=str,
-                        help="--num_documents")
+                        help="Путь к словарю: текстовому или компактному, собранному task_3/vocabulary.py")
     parser.add_argument('--num_documents', default=154, type=int, help="Число документов в коллекции")
     parser.add_argument('--request_string', default="иванов|ответ^бог", type=str,
                         help="Строка поискового запроса. Строка состоит из конъюнктов, разделенных символом '|'."
                              "Конъюнкт - набор лемм, которые должны (не должны) встретиться в документе совместно."
                              "Такие леммы разделены символом '^'. Если необходимо, чтобы леммы не было в документе,"
                              "перед ним ставится символ '~' без пробелов. Итого, примерный запрос выглядит так:"
-                             "<лемма_1>^~<лемма_2>^<лемма_3>|<лемма_4>^<лемма_5>")
-
+                             "<лемма_1>^~<лемма_2>^<лемма_3>|<лемма_4>^<лемма_5>. Вместо леммы можно указать "
+                             "шаблон с символом '*', например, 'книг*'")
+    parser.add_argument('--input_kgram_index_path', default=None, type=str,
+                        help="Путь к k-граммному индексу словаря, собранному task_3/kgram_index.py. Если указан, "
+                             "слова запроса вне словаря заменяются ближайшими словами словаря")
+    parser.add_argument('--input_shards_path', default=None, type=str,
+                        help="Путь к файлу описания шардов инвертированного индекса. Если указан, запрос "
+                             "выполняется параллельно на всех шардах, каждый в своём процессе, а параметры "
+                             "input_inv_index_path и num_documents не используются")
+    add_profiling_arguments(parser)
 
     args = parser.parse_args()
+    start_profiling(args)
     input_inv_index_path = args.input_inv_index_path
     input_dict_path = args.input_dict_path
     request_string = args.request_string
     num_documents = args.num_documents
 
-    # Подгружаем словарь в память
-    token2id = load_dict(input_dict_path)
-    # Подгружаем инвертированный индекс документов в память
-    inverted_index = load_inverted_index_from_file(input_inv_index_path)
-    # Выполняем поисковый запрос методом булева поиска
-    request_result = get_doc_ids_by_request(request_string, inverted_index, token2id, num_documents)
+    if args.input_shards_path is not None:
+        shards_meta = load_shards_meta(args.input_shards_path)
+        shard_initargs = [(input_dict_path, shard_path, first_doc_id, shard_num_documents,
+                           args.input_kgram_index_path)
+                          for shard_path, first_doc_id, shard_num_documents in shards_meta]
+        shard_pools = start_shard_workers(init_boolean_shard_worker, shard_initargs)
+        try:
+            request_result = get_doc_ids_by_request_sharded(request_string, shard_pools)
+        finally:
+            stop_shard_workers(shard_pools)
+    else:
+        # Подгружаем словарь в компактном виде, чтобы шаблоны с '*' раскрывались двоичным поиском
+        # по отсортированным терминам
+        with span("load.dict"):
+            token2id = load_vocabulary(input_dict_path)
+        # Подгружаем инвертированный индекс документов в память
+        with span("load.inverted_index"):
+            inverted_index = load_inverted_index_from_file(input_inv_index_path)
+        kgram_index = None
+        if args.input_kgram_index_path is not None:
+            with span("load.kgram_index"):
+                kgram_index = load_kgram_index(args.input_kgram_index_path, token2id)
+        # Выполняем поисковый запрос методом булева поиска
+        request_result = get_doc_ids_by_request(request_string, inverted_index, token2id, num_documents,
+                                                kgram_index=kgram_index)
     print(request_result)
+    finish_profiling(args)
 
 
 if __name__ == '__main__':
@@ -1,10 +1,54 @@
 import codecs
 import os
 from argparse import ArgumentParser
+from typing import Dict, List, Tuple
 
+from common.profiling import add_profiling_arguments, finish_profiling, span, start_profiling
+from task_3.sharding import get_shard_document_ranges, get_shard_path, positive_int, save_shards_meta
+from common.utils import replacing_file
 from task_3.utils import load_dict
 
 
+def build_inverted_index_shards(documents_path: str, token2id: Dict[str, int],
+                                document_ranges: List[Tuple[int, int]]) -> List[List[List[int]]]:
+    """
+    Строит инвертированные индексы шардов коллекции за один проход по файлу документов
+    :param documents_path: Путь к файлу, содержащему токенизированные документы
+    :param token2id: Словарь {слово : идентификатор слова в словаре}
+    :param document_ranges: Список пар (номер первого документа шарда, число документов шарда)
+    для подряд идущих шардов
+    :return: Инвертированный индекс каждого шарда: список из <размер словаря> списков
+    локальных (отсчитываемых от первого документа шарда) номеров документов
+    """
+    vocab_size = len(token2id.keys())
+    shard_inverted_indices = [[[] for i in range(vocab_size)] for _ in document_ranges]
+    shard_id = 0
+    with codecs.open(documents_path, 'r', encoding="utf-8") as documents_file:
+        for doc_id, doc_line in enumerate(documents_file):
+            first_doc_id, num_documents = document_ranges[shard_id]
+            while doc_id >= first_doc_id + num_documents:
+                shard_id += 1
+                first_doc_id, num_documents = document_ranges[shard_id]
+            inverted_index = shard_inverted_indices[shard_id]
+            doc_tokens = doc_line.strip().split()
+            doc_unique_token_ids = set((token2id[token] for token in doc_tokens))
+            for token_id in doc_unique_token_ids:
+                inverted_index[token_id].append(doc_id - first_doc_id)
+    return shard_inverted_indices
+
+
+def save_inverted_index(output_inv_index_path: str, inverted_index: List[List[int]]):
+    """
+    Сохраняет инвертированный индекс в файл. 1 строка=разделённые пробелами номера документов,
+    в которых содержится соответствующее слово словаря
+    :param output_inv_index_path: Выходной путь файла инвертированного индекса
+    :param inverted_index: Инвертированный индекс
+    """
+    with replacing_file(output_inv_index_path) as temporary_path, codecs.open(temporary_path, 'w+', ) as inv_index_file:
+        for token_ids_list in inverted_index:
+            inv_index_file.write(f"{' '.join((str(x) for x in token_ids_list))}\n")
+
+
 def main():
     parser = ArgumentParser()
     parser.add_argument('--input_documents_path', default=r"../task_2/tokenized_texts/documents.txt", type=str,
@@ -13,8 +57,17 @@ def main():
                         help="Путь к словарю")
     parser.add_argument('--output_inv_index_path', default=r"inverted_index/inv_index.txt", type=str,
                         help="Выходной путь файла инвертированного индекса")
+    parser.add_argument('--num_shards', default=1, type=positive_int,
+                        help="Число шардов индекса. При значении больше 1 документы делятся на шарды из подряд "
+                             "идущих документов, инвертированный индекс каждого шарда записывается в файл "
+                             "<output_inv_index_path>_shard_<номер шарда>, а описание шардов - в файл "
+                             "output_shards_path")
+    parser.add_argument('--output_shards_path', default=r"inverted_index/shards.txt", type=str,
+                        help="Выходной путь файла описания шардов")
+    add_profiling_arguments(parser)
 
     args = parser.parse_args()
+    start_profiling(args)
     input_documents_path = args.input_documents_path
     input_dict_path = args.input_dict_path
     output_inv_index_path = args.output_inv_index_path
@@ -22,18 +75,23 @@ def main():
     if not os.path.exists(output_dir) and output_dir != '':
         os.makedirs(output_dir)
 
-    token2id = load_dict(input_dict_path)
-    vocab_size = len(token2id.keys())
-    inverted_index = [[] for i in range(vocab_size)]
+    with span("load.dict"):
+        token2id = load_dict(input_dict_path)
     with codecs.open(input_documents_path, 'r', encoding="utf-8") as documents_file:
-        for doc_id, doc_line in enumerate(documents_file):
-            doc_tokens = doc_line.strip().split()
-            doc_unique_token_ids = set((token2id[token] for token in doc_tokens))
-            for token_id in doc_unique_token_ids:
-                inverted_index[token_id].append(doc_id)
-    with codecs.open(output_inv_index_path, 'w+', ) as inv_index_file:
-        for token_ids_list in inverted_index:
-            inv_index_file.write(f"{' '.join((str(x) for x in token_ids_list))}\n")
+        num_documents = sum(1 for _ in documents_file)
+    document_ranges = get_shard_document_ranges(num_documents, args.num_shards)
+    with span("build.inverted_index"):
+        shard_inverted_indices = build_inverted_index_shards(input_documents_path, token2id=token2id,
+                                                             document_ranges=document_ranges)
+    with span("save.inverted_index"):
+        if args.num_shards == 1:
+            save_inverted_index(output_inv_index_path, shard_inverted_indices[0])
+        else:
+            shard_paths = [get_shard_path(output_inv_index_path, shard_id) for shard_id in range(args.num_shards)]
+            for shard_path, inverted_index in zip(shard_paths, shard_inverted_indices):
+                save_inverted_index(shard_path, inverted_index)
+            save_shards_meta(args.output_shards_path, shard_paths=shard_paths, document_ranges=document_ranges)
+    finish_profiling(args)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,222 @@
+import codecs
+import os
+import threading
+from argparse import ArgumentParser
+from collections import defaultdict
+from typing import Dict, Mapping, NamedTuple, Optional, Sequence, Set
+
+import numpy as np
+
+from common.profiling import increment, span
+from common.utils import replacing_file
+from task_3.utils import load_dict
+from task_3.vocabulary import get_id2token, get_vocabulary_fingerprint
+
+# Символ, которым дополняются границы слова перед разбиением на k-граммы
+BOUNDARY_SYMBOL = '$'
+# Число запомненных исправлений слов, после которого самые старые исправления забываются
+CORRECTION_CACHE_SIZE = 100000
+# Кэш исправлений пополняется из нескольких потоков обработки запросов
+_correction_cache_lock = threading.Lock()
+
+
+class KGramIndex(NamedTuple):
+    """
+    k-граммный индекс словаря для поиска слов, близких к словам вне словаря:
+    k - длина k-граммы;
+    kgram2term_ids - словарь {k-грамма : массив номеров слов словаря, содержащих k-грамму};
+    id2token - последовательность слов словаря в порядке их номеров;
+    term_lengths - массив длин слов словаря в порядке их номеров;
+    term_kgram_counts - массив чисел различных k-грамм слов словаря в порядке их номеров;
+    vocabulary_fingerprint - отпечаток словаря, по которому построен индекс (см. get_vocabulary_fingerprint);
+    correction_cache - словарь {слово вне словаря : номер исправления или None}. Номера исправлений
+    относятся к словарю этого индекса, поэтому кэш живёт и заменяется вместе с индексом; обращения
+    к нему выполняются под блокировкой
+    """
+    k: int
+    kgram2term_ids: Dict[str, np.ndarray]
+    id2token: Sequence[str]
+    term_lengths: np.ndarray
+    term_kgram_counts: np.ndarray
+    vocabulary_fingerprint: str
+    correction_cache: Dict[str, Optional[int]]
+
+
+def get_kgrams(term: str, k: int) -> Set[str]:
+    """
+    :param term: Слово
+    :param k: Длина k-граммы
+    :return: Множество k-грамм слова, дополненного с обеих сторон символом BOUNDARY_SYMBOL
+    """
+    padded_term = f"{BOUNDARY_SYMBOL}{term}{BOUNDARY_SYMBOL}"
+    if len(padded_term) <= k:
+        return {padded_term}
+    return {padded_term[i:i + k] for i in range(len(padded_term) - k + 1)}
+
+
+def _create_kgram_index(k: int, kgram2term_ids: Dict[str, np.ndarray], id2token: Sequence[str],
+                        vocabulary_fingerprint: str) -> KGramIndex:
+    # Длины слов и числа их k-грамм считаются один раз, чтобы при поиске исправления не разбивать кандидатов
+    # на k-граммы. Каждое слово входит в список каждой своей k-граммы ровно один раз
+    term_lengths = np.fromiter((len(term) for term in id2token), dtype=np.int32, count=len(id2token))
+    term_kgram_counts = np.zeros(len(id2token), dtype=np.int32)
+    for term_ids in kgram2term_ids.values():
+        term_kgram_counts[term_ids] += 1
+    return KGramIndex(k=k, kgram2term_ids=kgram2term_ids, id2token=id2token, term_lengths=term_lengths,
+                      term_kgram_counts=term_kgram_counts, vocabulary_fingerprint=vocabulary_fingerprint,
+                      correction_cache={})
+
+
+def build_kgram_index(token2id: Mapping[str, int], k: int) -> KGramIndex:
+    """
+    :param token2id: Словарь {слово : идентификатор слова в словаре}
+    :param k: Длина k-граммы
+    :return: k-граммный индекс словаря
+    """
+    kgram2term_ids = defaultdict(list)
+    id2token = get_id2token(token2id)
+    for term_id, term in enumerate(id2token):
+        for kgram in get_kgrams(term, k):
+            kgram2term_ids[kgram].append(term_id)
+    kgram2term_ids = {kgram: np.array(term_ids, dtype=np.int32) for kgram, term_ids in kgram2term_ids.items()}
+    return _create_kgram_index(k, kgram2term_ids=kgram2term_ids, id2token=id2token,
+                               vocabulary_fingerprint=get_vocabulary_fingerprint(token2id))
+
+
+def save_kgram_index(kgram_index_path: str, kgram_index: KGramIndex):
+    """
+    Сохраняет k-граммный индекс в файл. Первая строка содержит k и отпечаток словаря, разделённые
+    табуляцией, каждая следующая - <k-грамма>\t<разделённые пробелами номера слов словаря, содержащих k-грамму>
+    :param kgram_index_path: Выходной путь файла k-граммного индекса
+    :param kgram_index: k-граммный индекс
+    """
+    with replacing_file(kgram_index_path) as temporary_path, \
+            codecs.open(temporary_path, 'w+', encoding="utf-8") as kgram_index_file:
+        kgram_index_file.write(f"{kgram_index.k}\t{kgram_index.vocabulary_fingerprint}\n")
+        for kgram, term_ids in kgram_index.kgram2term_ids.items():
+            kgram_index_file.write(f"{kgram}\t{' '.join(str(x) for x in term_ids)}\n")
+
+
+def load_kgram_index(kgram_index_path: str, token2id: Mapping[str, int]) -> KGramIndex:
+    """
+    :param kgram_index_path: Путь к файлу, сохранённому save_kgram_index
+    :param token2id: Словарь, по которому строился k-граммный индекс. task_2 нумерует слова заново
+    при каждом запуске, поэтому индекс, построенный по другому словарю, не загружается
+    :return: k-граммный индекс
+    """
+    kgram2term_ids = {}
+    with codecs.open(kgram_index_path, 'r', encoding="utf-8") as kgram_index_file:
+        header = kgram_index_file.readline().rstrip('\n').split('\t')
+        vocabulary_fingerprint = get_vocabulary_fingerprint(token2id)
+        if len(header) != 2 or header[1] != vocabulary_fingerprint:
+            raise ValueError(f"k-gram index {kgram_index_path} was built for another vocabulary. "
+                             f"Rebuild it with task_3/kgram_index.py")
+        k = int(header[0])
+        for line in kgram_index_file:
+            kgram, term_ids = line.rstrip('\n').split('\t')
+            kgram2term_ids[kgram] = np.array(term_ids.split(), dtype=np.int32)
+    return _create_kgram_index(k, kgram2term_ids=kgram2term_ids, id2token=get_id2token(token2id),
+                               vocabulary_fingerprint=vocabulary_fingerprint)
+
+
+def bounded_levenshtein_distance(first: str, second: str, max_distance: int) -> Optional[int]:
+    """
+    Считает расстояние Левенштейна, прекращая вычисление, как только оно гарантированно превысит max_distance
+    :param first: Первое слово
+    :param second: Второе слово
+    :param max_distance: Максимальное интересующее расстояние
+    :return: Расстояние Левенштейна или None, если оно больше max_distance
+    """
+    if abs(len(first) - len(second)) > max_distance:
+        return None
+    previous_row = list(range(len(second) + 1))
+    for i, first_char in enumerate(first, 1):
+        current_row = [i]
+        for j, second_char in enumerate(second, 1):
+            current_row.append(min(previous_row[j] + 1, current_row[j - 1] + 1,
+                                   previous_row[j - 1] + (first_char != second_char)))
+        # Значения в строке матрицы расстояний не убывают от строки к строке
+        if min(current_row) > max_distance:
+            return None
+        previous_row = current_row
+    return previous_row[-1] if previous_row[-1] <= max_distance else None
+
+
+def find_closest_term_id(kgram_index: KGramIndex, term: str, max_distance: int = 2, min_jaccard: float = 0.2,
+                         max_candidates: int = 100, max_postings: int = 100000) -> Optional[int]:
+    """
+    Находит слово словаря, ближайшее к слову вне словаря. Кандидаты - слова, длина которых отличается
+    не больше чем на max_distance, с наибольшим коэффициентом Жаккара между множествами их k-грамм
+    и k-грамм исходного слова; из них выбирается слово с наименьшим расстоянием Левенштейна.
+    Результат запоминается
+    :param kgram_index: k-граммный индекс словаря
+    :param term: Слово вне словаря
+    :param max_distance: Максимальное расстояние Левенштейна до исправления
+    :param min_jaccard: Минимальный коэффициент Жаккара кандидата
+    :param max_candidates: Максимальное число кандидатов, для которых считается расстояние Левенштейна
+    :param max_postings: Максимальное суммарное число просматриваемых номеров слов в списках k-грамм.
+    Списки просматриваются от коротких к длинным, так что частые k-граммы, меньше всего
+    отличающие слова друг от друга, отбрасываются первыми
+    :return: Номер ближайшего слова словаря или None, если подходящего слова нет
+    """
+    correction_cache = kgram_index.correction_cache
+    with _correction_cache_lock:
+        if term in correction_cache:
+            increment("correction_cache_hits")
+            return correction_cache[term]
+    with span("fuzzy_match"):
+        term_kgrams = get_kgrams(term, kgram_index.k)
+        kgram_term_ids = sorted((kgram_index.kgram2term_ids[kgram] for kgram in term_kgrams
+                                 if kgram in kgram_index.kgram2term_ids), key=len)
+        num_postings = 0
+        for num_kgrams, term_ids in enumerate(kgram_term_ids):
+            if num_postings + len(term_ids) > max_postings and num_kgrams > 0:
+                kgram_term_ids = kgram_term_ids[:num_kgrams]
+                break
+            num_postings += len(term_ids)
+        increment("fuzzy_postings", num_postings)
+        closest_term_id = None
+        if kgram_term_ids:
+            candidate_ids = np.concatenate(kgram_term_ids)
+            # Слова, длина которых отличается больше чем на max_distance, не могут быть исправлением
+            candidate_ids = candidate_ids[np.abs(kgram_index.term_lengths[candidate_ids] - len(term)) <= max_distance]
+            candidate_ids, overlaps = np.unique(candidate_ids, return_counts=True)
+            jaccards = overlaps / (len(term_kgrams) + kgram_index.term_kgram_counts[candidate_ids] - overlaps)
+            is_candidate = jaccards >= min_jaccard
+            candidate_ids, jaccards = candidate_ids[is_candidate], jaccards[is_candidate]
+            increment("fuzzy_candidates", len(candidate_ids))
+            # Кандидаты в порядке убывания коэффициента Жаккара, при равенстве - возрастания номера
+            candidate_order = np.lexsort((candidate_ids, -jaccards))[:max_candidates]
+            closest_distance = max_distance + 1
+            for candidate_id in candidate_ids[candidate_order].tolist():
+                distance = bounded_levenshtein_distance(term, kgram_index.id2token[candidate_id],
+                                                        max_distance=closest_distance - 1)
+                if distance is not None:
+                    closest_term_id, closest_distance = candidate_id, distance
+                    if distance == 1:
+                        break
+    with _correction_cache_lock:
+        if len(correction_cache) >= CORRECTION_CACHE_SIZE:
+            correction_cache.pop(next(iter(correction_cache)))
+        correction_cache[term] = closest_term_id
+    return closest_term_id
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--input_dict_path', default=r"../task_2/tokenized_texts/dict.txt", type=str,
+                        help="Путь к словарю")
+    parser.add_argument('--k', default=3, type=int, help="Длина k-граммы")
+    parser.add_argument('--output_kgram_index_path', default=r"../task_2/tokenized_texts/kgram_index.txt", type=str,
+                        help="Выходной путь файла k-граммного индекса словаря")
+    args = parser.parse_args()
+    output_dir = os.path.dirname(args.output_kgram_index_path)
+    if not os.path.exists(output_dir) and output_dir != '':
+        os.makedirs(output_dir)
+
+    token2id = load_dict(args.input_dict_path)
+    save_kgram_index(args.output_kgram_index_path, build_kgram_index(token2id, k=args.k))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+import codecs
+import os
+from argparse import ArgumentTypeError
+from multiprocessing import Pool
+from typing import Callable, List, Tuple
+
+from common.profiling import enable_stats, get_counters, get_span_durations, merge_stats, reset_stats, stats_enabled
+
+
+def positive_int(value: str) -> int:
+    """
+    Тип аргумента командной строки для числа шардов
+    :param value: Строковое значение аргумента
+    :return: Целое число не меньше 1
+    """
+    number = int(value)
+    if number < 1:
+        raise ArgumentTypeError(f"expected an integer >= 1, got {value}")
+    return number
+
+
+def get_shard_document_ranges(num_documents: int, num_shards: int) -> List[Tuple[int, int]]:
+    """
+    Делит документы коллекции на num_shards шардов из подряд идущих документов примерно равного размера
+    :param num_documents: Число документов в коллекции
+    :param num_shards: Число шардов
+    :return: Список пар (номер первого документа шарда, число документов шарда)
+    """
+    if num_shards < 1:
+        raise ValueError(f"Number of shards must be >= 1, got {num_shards}")
+    base_size, remainder = divmod(num_documents, num_shards)
+    document_ranges = []
+    first_doc_id = 0
+    for shard_id in range(num_shards):
+        shard_size = base_size + (1 if shard_id < remainder else 0)
+        document_ranges.append((first_doc_id, shard_size))
+        first_doc_id += shard_size
+    return document_ranges
+
+
+def get_shard_path(path: str, shard_id: int) -> str:
+    """
+    :param path: Путь к файлу нешардированного индекса
+    :param shard_id: Номер шарда
+    :return: Путь к файлу шарда: к имени файла перед расширением добавляется _shard_<номер шарда>
+    """
+    stem, extension = os.path.splitext(path)
+    return f"{stem}_shard_{shard_id}{extension}"
+
+
+def save_shards_meta(shards_meta_path: str, shard_paths: List[str], document_ranges: List[Tuple[int, int]]):
+    """
+    Сохраняет описание шардов индекса. 1 строка=<путь к шарду>\t<номер первого документа>\t<число документов>.
+    Пути к шардам записываются относительно директории файла описания
+    :param shards_meta_path: Путь к файлу описания шардов
+    :param shard_paths: Пути к файлам шардов
+    :param document_ranges: Список пар (номер первого документа шарда, число документов шарда)
+    """
+    meta_dir = os.path.dirname(shards_meta_path)
+    with codecs.open(shards_meta_path, 'w+', encoding="utf-8") as meta_file:
+        for shard_path, (first_doc_id, num_documents) in zip(shard_paths, document_ranges):
+            meta_file.write(f"{os.path.relpath(shard_path, meta_dir or '.')}\t{first_doc_id}\t{num_documents}\n")
+
+
+def load_shards_meta(shards_meta_path: str) -> List[Tuple[str, int, int]]:
+    """
+    :param shards_meta_path: Путь к файлу описания шардов, сохранённому save_shards_meta
+    :return: Список троек (путь к шарду, номер первого документа шарда, число документов шарда)
+    """
+    meta_dir = os.path.dirname(shards_meta_path)
+    shards_meta = []
+    with codecs.open(shards_meta_path, 'r', encoding="utf-8") as meta_file:
+        for line in meta_file:
+            shard_path, first_doc_id, num_documents = line.strip().split('\t')
+            shards_meta.append((os.path.join(meta_dir, shard_path), int(first_doc_id), int(num_documents)))
+    return shards_meta
+
+
+def start_shard_workers(initializer: Callable, shard_initargs: List[tuple]) -> List[Pool]:
+    """
+    Запускает по одному процессу-обработчику на шард. Каждый процесс при запуске вызывает
+    initializer со своими аргументами, загружая в память свой шард, и затем обслуживает
+    запросы только к нему
+    :param initializer: Функция загрузки шарда в процессе-обработчике
+    :param shard_initargs: Аргументы initializer для каждого шарда
+    :return: Список пулов из одного процесса, по одному на шард
+    """
+    return [Pool(processes=1, initializer=initializer, initargs=initargs) for initargs in shard_initargs]
+
+
+def run_task_with_stats(function: Callable, args: tuple, collect_stats: bool) -> tuple:
+    """
+    Выполняет function(*args) в процессе-обработчике. Статистика процесса-обработчика собирается
+    отдельно по каждой задаче и возвращается вместе с результатом для merge_stats
+    :param function: Функция задачи. Должна быть объявлена на уровне модуля
+    :param args: Аргументы function
+    :param collect_stats: Собирать ли статистику
+    :return: Кортеж (результат, отрезки, счётчики). Без сбора статистики отрезки и счётчики - None
+    """
+    enable_stats(collect_stats)
+    if not collect_stats:
+        return function(*args), None, None
+    reset_stats()
+    result = function(*args)
+    return result, get_span_durations(), get_counters()
+
+
+def scatter_gather(shard_pools: List[Pool], function: Callable, args: tuple) -> list:
+    """
+    Параллельно выполняет function(*args) в процессах-обработчиках всех шардов и дожидается результатов.
+    Если сбор статистики включён, отрезки и счётчики, записанные обработчиками, добавляются в статистику
+    текущего процесса
+    :param shard_pools: Пулы процессов-обработчиков шардов
+    :param function: Функция обработки запроса к шарду. Должна быть объявлена на уровне модуля
+    :param args: Аргументы function
+    :return: Список результатов в порядке шардов
+    """
+    collect_stats = stats_enabled()
+    async_results = [shard_pool.apply_async(run_task_with_stats, (function, args, collect_stats))
+                     for shard_pool in shard_pools]
+    results = []
+    for async_result in async_results:
+        result, span_durations, counters = async_result.get()
+        if collect_stats:
+            merge_stats(span_durations, counters)
+        results.append(result)
+    return results
+
+
+def stop_shard_workers(shard_pools: List[Pool]):
+    """
+    Завершает процессы-обработчики шардов
+    :param shard_pools: Пулы процессов-обработчиков шардов
+    """
+    for shard_pool in shard_pools:
+        shard_pool.close()
+    for shard_pool in shard_pools:
+        shard_pool.join()
@@ -1,14 +1,20 @@
 import codecs
-from typing import Dict, List, Set
+from typing import List, Mapping, Set
 
+from task_3.vocabulary import is_compact_vocabulary_file, load_compact_vocabulary
 
-def load_dict(dict_file_path: str) -> Dict[str, int]:
+
+def load_dict(dict_file_path: str) -> Mapping[str, int]:
     """
     Загружает словарь, в данном случае - словарь лемм, из файла
     :param dict_file_path: путь до файла словаря, каждая строка которого
-    содержит 1 слово.
-    :return: Словарь {слово : идентификатор слова в словаре}
+    содержит 1 слово, или до файла компактного словаря, сохранённого task_3/vocabulary.py
+    :return: Словарь {слово : идентификатор слова в словаре}. Для компактного словаря -
+    отображённый в память CompactVocabulary с тем же интерфейсом. Поиск в нём в десятки раз медленнее,
+    поэтому при построении индексов лучше передавать текстовый словарь
     """
+    if is_compact_vocabulary_file(dict_file_path):
+        return load_compact_vocabulary(dict_file_path)
     token2id = {}
     with codecs.open(dict_file_path, 'r', encoding="utf-8") as dict_file:
         for idx, line in enumerate(dict_file):
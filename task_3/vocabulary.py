@@ -0,0 +1,286 @@
+import codecs
+import hashlib
+import mmap
+import os
+import re
+import struct
+from argparse import ArgumentParser
+from array import array
+from collections.abc import Mapping, Sequence
+from typing import Iterator, List, Optional, Union
+
+VOCABULARY_MAGIC = b"IRVOCAB1"
+# Число терминов и длина блока строк в байтах
+_HEADER_FORMAT = "<QQ"
+# Символ шаблона, заменяющий любую (в том числе пустую) последовательность символов
+WILDCARD = '*'
+# Байт 0xff не встречается в UTF-8, поэтому строка <префикс> + 0xff больше любой строки, начинающейся с префикса
+_PREFIX_UPPER_BOUND_SUFFIX = b"\xff"
+
+
+def serialize_vocabulary(terms: List[str]) -> bytes:
+    """
+    Упаковывает словарь в компактное бинарное представление: сигнатура VOCABULARY_MAGIC, число
+    терминов, длина блока строк, затем массивы (в порядке байтов текущей машины): смещения строк
+    в отсортированном блоке (uint64, число терминов + 1), номера терминов в порядке сортировки
+    (uint32), позиции терминов в сортировке в порядке номеров (uint32) и сам блок отсортированных
+    по байтам UTF-8 строк терминов
+    :param terms: Список терминов. Номер термина - его позиция в списке
+    :return: Бинарное представление словаря
+    """
+    encoded_terms = [term.encode("utf-8") for term in terms]
+    sorted_term_ids = array('I', sorted(range(len(terms)), key=lambda term_id: encoded_terms[term_id]))
+    term_positions = array('I', bytes(4 * len(terms)))
+    offsets = array('Q', [0])
+    for position, term_id in enumerate(sorted_term_ids):
+        term_positions[term_id] = position
+        offsets.append(offsets[-1] + len(encoded_terms[term_id]))
+    terms_data = b"".join(encoded_terms[term_id] for term_id in sorted_term_ids)
+    return b"".join((VOCABULARY_MAGIC, struct.pack(_HEADER_FORMAT, len(terms), len(terms_data)),
+                     offsets.tobytes(), sorted_term_ids.tobytes(), term_positions.tobytes(), terms_data))
+
+
+class _TermsById(Sequence):
+    """
+    Представление компактного словаря в виде последовательности терминов в порядке их номеров.
+    Заменяет инвертированный словарь {номер термина : термин}, не создавая его
+    """
+
+    def __init__(self, vocabulary: "CompactVocabulary"):
+        self._vocabulary = vocabulary
+
+    def __getitem__(self, term_id: int) -> str:
+        return self._vocabulary.get_term(term_id)
+
+    def __len__(self) -> int:
+        return len(self._vocabulary)
+
+
+class CompactVocabulary(Mapping):
+    """
+    Словарь {термин : номер термина}, хранящийся в одном непрерывном буфере (байтовой строке
+    или отображённом в память файле) в формате serialize_vocabulary. Поиск номера термина -
+    двоичный поиск по отсортированным строкам, поиск термина по номеру - обращение к массиву.
+    Поддерживает интерфейс Mapping и потому может использоваться вместо token2id, возвращаемого load_dict.
+    Двоичный поиск выполняется на Python и в десятки раз медленнее поиска в dict, поэтому компактный
+    словарь предназначен для обработки запросов, а не для построения индексов по всей коллекции.
+    Номер термина лучше получать одним вызовом get, а не проверкой in и последующим обращением по ключу
+    """
+
+    def __init__(self, buffer: Union[bytes, mmap.mmap, memoryview]):
+        buffer = memoryview(buffer).cast('B')
+        if bytes(buffer[:len(VOCABULARY_MAGIC)]) != VOCABULARY_MAGIC:
+            raise ValueError("Invalid compact vocabulary buffer")
+        header_end = len(VOCABULARY_MAGIC) + struct.calcsize(_HEADER_FORMAT)
+        num_terms, terms_data_length = struct.unpack(_HEADER_FORMAT, buffer[len(VOCABULARY_MAGIC):header_end])
+        offsets_end = header_end + 8 * (num_terms + 1)
+        sorted_term_ids_end = offsets_end + 4 * num_terms
+        term_positions_end = sorted_term_ids_end + 4 * num_terms
+        self._buffer = buffer
+        self._num_terms = num_terms
+        self._offsets = buffer[header_end:offsets_end].cast('Q')
+        self._sorted_term_ids = buffer[offsets_end:sorted_term_ids_end].cast('I')
+        self._term_positions = buffer[sorted_term_ids_end:term_positions_end].cast('I')
+        self._terms_data = buffer[term_positions_end:term_positions_end + terms_data_length]
+
+    def _get_term_bytes(self, position: int) -> bytes:
+        return bytes(self._terms_data[self._offsets[position]:self._offsets[position + 1]])
+
+    def _bisect_left(self, key: bytes) -> int:
+        low, high = 0, self._num_terms
+        while low < high:
+            middle = (low + high) // 2
+            if self._get_term_bytes(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def get(self, term: str, default: Optional[int] = None) -> Optional[int]:
+        """
+        :param term: Термин
+        :param default: Значение, возвращаемое для термина вне словаря
+        :return: Номер термина или default. Выполняет один двоичный поиск
+        """
+        if not isinstance(term, str):
+            return default
+        key = term.encode("utf-8")
+        position = self._bisect_left(key)
+        if position < self._num_terms and self._get_term_bytes(position) == key:
+            return self._sorted_term_ids[position]
+        return default
+
+    def __getitem__(self, term: str) -> int:
+        term_id = self.get(term)
+        if term_id is None:
+            raise KeyError(term)
+        return term_id
+
+    def __contains__(self, term) -> bool:
+        return self.get(term) is not None
+
+    def __iter__(self) -> Iterator[str]:
+        for term_id in range(self._num_terms):
+            yield self.get_term(term_id)
+
+    def __len__(self) -> int:
+        return self._num_terms
+
+    def get_term(self, term_id: int) -> str:
+        """
+        :param term_id: Номер термина
+        :return: Термин с номером term_id
+        """
+        return self._get_term_bytes(self._term_positions[term_id]).decode("utf-8")
+
+    @property
+    def id2token(self) -> Sequence:
+        """
+        :return: Последовательность терминов в порядке их номеров
+        """
+        return _TermsById(self)
+
+    def expand_pattern(self, pattern: str) -> List[int]:
+        """
+        Находит номера всех терминов, подходящих под шаблон. Символ '*' в шаблоне заменяет
+        любую последовательность символов. Просматриваются только термины, начинающиеся
+        с части шаблона до первого '*'
+        :param pattern: Шаблон, например, 'книг*'
+        :return: Номера подходящих терминов в порядке сортировки терминов
+        """
+        prefix = pattern.split(WILDCARD, 1)[0]
+        prefix_bytes = prefix.encode("utf-8")
+        start = self._bisect_left(prefix_bytes)
+        end = self._bisect_left(prefix_bytes + _PREFIX_UPPER_BOUND_SUFFIX)
+        if pattern == prefix + WILDCARD:
+            return [self._sorted_term_ids[position] for position in range(start, end)]
+        pattern_regex = compile_pattern(pattern)
+        return [self._sorted_term_ids[position] for position in range(start, end)
+                if pattern_regex.fullmatch(self._get_term_bytes(position).decode("utf-8"))]
+
+
+def compile_pattern(pattern: str):
+    """
+    :param pattern: Шаблон с символами '*'
+    :return: Регулярное выражение, которому полностью соответствуют подходящие под шаблон термины
+    """
+    return re.compile(".*".join(re.escape(part) for part in pattern.split(WILDCARD)), flags=re.DOTALL)
+
+
+def expand_term_pattern(token2id: Mapping, pattern: str) -> List[int]:
+    """
+    Находит номера всех терминов словаря, подходящих под шаблон
+    :param token2id: Словарь {слово : идентификатор слова в словаре}: CompactVocabulary или обычный dict.
+    Для обычного dict просматриваются все термины словаря, и регулярное выражение проверяется только
+    для терминов с нужным префиксом. Для многократного поиска по шаблонам словарь лучше
+    загрузить функцией load_vocabulary
+    :param pattern: Шаблон, например, 'книг*'
+    :return: Номера подходящих терминов
+    """
+    if isinstance(token2id, CompactVocabulary):
+        return token2id.expand_pattern(pattern)
+    prefix = pattern.split(WILDCARD, 1)[0]
+    if pattern == prefix + WILDCARD:
+        return [token_id for token, token_id in token2id.items() if token.startswith(prefix)]
+    pattern_regex = compile_pattern(pattern)
+    return [token_id for token, token_id in token2id.items()
+            if token.startswith(prefix) and pattern_regex.fullmatch(token)]
+
+
+def get_id2token(token2id: Mapping) -> Sequence:
+    """
+    :param token2id: Словарь {слово : идентификатор слова в словаре}: CompactVocabulary или обычный dict
+    :return: Последовательность терминов в порядке их номеров
+    """
+    if isinstance(token2id, CompactVocabulary):
+        return token2id.id2token
+    id2token = [None] * len(token2id)
+    for token, token_id in token2id.items():
+        id2token[token_id] = token
+    return id2token
+
+
+def get_vocabulary_fingerprint(token2id: Mapping) -> str:
+    """
+    Отпечаток словаря для проверки, что индекс построен по тому же словарю. task_2 нумерует термины
+    заново при каждом запуске, поэтому отпечаток зависит не только от состава терминов, но и от их номеров
+    :param token2id: Словарь {слово : идентификатор слова в словаре}: CompactVocabulary или обычный dict
+    :return: Строка "<число терминов>:<SHA-1 терминов в порядке номеров>"
+    """
+    digest = hashlib.sha1()
+    for term in get_id2token(token2id):
+        digest.update(term.encode("utf-8"))
+        digest.update(b"\n")
+    return f"{len(token2id)}:{digest.hexdigest()}"
+
+
+def is_compact_vocabulary_file(path: str) -> bool:
+    """
+    :param path: Путь к файлу словаря
+    :return: True, если файл сохранён save_compact_vocabulary
+    """
+    with open(path, "rb") as vocabulary_file:
+        return vocabulary_file.read(len(VOCABULARY_MAGIC)) == VOCABULARY_MAGIC
+
+
+def save_compact_vocabulary(vocabulary_path: str, terms: List[str]):
+    """
+    :param vocabulary_path: Путь к выходному файлу компактного словаря
+    :param terms: Список терминов. Номер термина - его позиция в списке
+    """
+    with open(vocabulary_path, "wb") as vocabulary_file:
+        vocabulary_file.write(serialize_vocabulary(terms))
+
+
+def load_compact_vocabulary(vocabulary_path: str) -> CompactVocabulary:
+    """
+    Отображает файл компактного словаря в память без чтения его целиком
+    :param vocabulary_path: Путь к файлу, сохранённому save_compact_vocabulary
+    :return: Компактный словарь
+    """
+    with open(vocabulary_path, "rb") as vocabulary_file:
+        vocabulary_mmap = mmap.mmap(vocabulary_file.fileno(), 0, access=mmap.ACCESS_READ)
+    return CompactVocabulary(vocabulary_mmap)
+
+
+def read_dict_terms(dict_path: str) -> List[str]:
+    """
+    :param dict_path: Путь к текстовому словарю, каждая строка которого содержит 1 слово
+    :return: Список терминов. Номер термина - его позиция в списке
+    """
+    with codecs.open(dict_path, 'r', encoding="utf-8") as dict_file:
+        return [line.strip() for line in dict_file]
+
+
+def load_vocabulary(dict_path: str) -> CompactVocabulary:
+    """
+    Загружает словарь сразу в компактном виде. Файл компактного словаря отображается в память,
+    текстовый словарь упаковывается в память без промежуточного dict
+    :param dict_path: Путь к текстовому словарю или к файлу, сохранённому save_compact_vocabulary
+    :return: Компактный словарь. Поиск по шаблону в нём просматривает только отсортированный
+    диапазон терминов с префиксом шаблона
+    """
+    if is_compact_vocabulary_file(dict_path):
+        return load_compact_vocabulary(dict_path)
+    return CompactVocabulary(serialize_vocabulary(read_dict_terms(dict_path)))
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--input_dict_path', default=r"../task_2/tokenized_texts/dict.txt", type=str,
+                        help="Путь к текстовому словарю, каждая строка которого содержит 1 слово")
+    parser.add_argument('--output_vocab_path', default=r"vocabulary/vocab.bin", type=str,
+                        help="Выходной путь файла компактного словаря. Его можно передавать вместо текстового "
+                             "словаря в параметре input_dict_path скриптов, обрабатывающих запросы "
+                             "(task_3/boolean_search.py). Скриптам построения индексов нужен текстовый словарь: "
+                             "поиск термина в компактном словаре в десятки раз медленнее")
+    args = parser.parse_args()
+    output_dir = os.path.dirname(args.output_vocab_path)
+    if not os.path.exists(output_dir) and output_dir != '':
+        os.makedirs(output_dir)
+
+    save_compact_vocabulary(args.output_vocab_path, read_dict_terms(args.input_dict_path))
+
+
+if __name__ == '__main__':
+    main()
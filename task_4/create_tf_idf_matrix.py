@@ -3,11 +3,15 @@ import math
 import os
 from argparse import ArgumentParser
 from collections import Counter
-from typing import Dict, Tuple
+from typing import Dict, Sequence, Tuple
 
+import numpy as np
 from scipy.sparse import csr_matrix
 
+from common.profiling import add_profiling_arguments, finish_profiling, span, start_profiling
+from common.utils import replacing_file
 from task_3.utils import load_dict
+from task_3.vocabulary import get_id2token
 
 
 def get_df_sparse_tf_matrices_from_file(documents_path: str, token2id: Dict[str, int]) \
@@ -56,36 +60,32 @@ def calculate_sparse_tf_idf_matrix(term_frequencies_sparse_matrix: csr_matrix,
     """
     # Узнаём общее число документов и размер словаря
     num_documents, vocab_size = term_frequencies_sparse_matrix.shape
-    # Создаём пустую разреженную матрицу
-    tf_idf_sparse_matrix = csr_matrix((num_documents, vocab_size), dtype=float)
-    non_empty_row_ids, non_empty_col_ids = term_frequencies_sparse_matrix.nonzero()
-    # Итерируемся по ненулевым элементам разреженной матрицы TF
-    for doc_id, token_id in zip(non_empty_row_ids, non_empty_col_ids):
-        # Берём частоту термина в документе из матрицы TF
-        tf = term_frequencies_sparse_matrix[doc_id, token_id]
-        # Считаем инвертированную документную частоту термина (IDF)
-        idf = num_documents / documents_frequencies[token_id]
-        # TF-IDF = TF * log(IDF)
-        tf_log_idf_value = tf * math.log2(idf)
-        tf_idf_sparse_matrix[doc_id, token_id] = tf_log_idf_value
+    # Считаем логарифм инвертированной документной частоты (IDF) каждого термина
+    log_idf_vector = np.zeros(vocab_size, dtype=float)
+    for token_id, document_frequency in documents_frequencies.items():
+        log_idf_vector[token_id] = math.log2(num_documents / document_frequency)
+    # TF-IDF = TF * log(IDF): умножаем каждый столбец матрицы TF на log IDF соответствующего термина
+    tf_idf_sparse_matrix = csr_matrix(term_frequencies_sparse_matrix.multiply(log_idf_vector.reshape(1, -1)),
+                                      dtype=float)
     return tf_idf_sparse_matrix
 
 
-def save_df_matrix(save_path: str, df: Counter, id2token: Dict[int, str]):
+def save_df_matrix(save_path: str, df: Counter, id2token: Sequence[str]):
     """
     Сохраняет вектор DF в файл. 1 строка=<токен>\t<его частота> в порядке убывания
     документной частоты
     :param save_path: Путь к файлу, в который будет сохранен вектор DF
     :param df: Вектор DF
-    :param id2token: Инвертированный словарь, возвращающий токен по номеру
+    :param id2token: Инвертированный словарь (последовательность), возвращающий токен по номеру
     его позиции в словаре
     """
-    with codecs.open(save_path, 'w+', encoding="utf-8") as output_file:
+    with replacing_file(save_path) as temporary_path, \
+            codecs.open(temporary_path, 'w+', encoding="utf-8") as output_file:
         for token_id, frequency in df.most_common():
             output_file.write(f"{id2token[token_id]}\t{frequency}\n")
 
 
-def save_tf_idf_matrix(save_path: str, df_vector: Counter, tf_idf_sparse_matrix, id2token: Dict[int, str], sep="~~~"):
+def save_tf_idf_matrix(save_path: str, df_vector: Counter, tf_idf_sparse_matrix, id2token: Sequence[str], sep="~~~"):
     """
     Сохраняет TF-IDF матрицу в файл. 1 строка соответствует одному документу.
     Пары <термин, idf термина, tf-idf термина> разделены между собой пробелом.
@@ -93,14 +93,15 @@ def save_tf_idf_matrix(save_path: str, df_vector: Counter, tf_idf_sparse_matrix,
     :param df_vector: Вектор документных частот (DF) терминов
     :param save_path: Путь к файлу, в который будут сохранены значения IDF и TF-IDF
     :param tf_idf_sparse_matrix: Разреженная матрица TF-IDF
-    :param id2token: Инвертированный словарь, возвращающий токен по номеру
+    :param id2token: Инвертированный словарь (последовательность), возвращающий токен по номеру
     его позиции в словаре
     :param sep: Разделитель между термином и его значениями IDF и TF-IDF
     """
     current_doc_id = 0
     num_documents = tf_idf_sparse_matrix.shape[0]
     non_empty_row_ids, non_empty_col_ids = tf_idf_sparse_matrix.nonzero()
-    with codecs.open(save_path, 'w+', encoding="utf-8") as output_file:
+    with replacing_file(save_path) as temporary_path, \
+            codecs.open(temporary_path, 'w+', encoding="utf-8") as output_file:
         for doc_id, token_id in zip(non_empty_row_ids, non_empty_col_ids):
             tf_idf_value = tf_idf_sparse_matrix[doc_id, token_id]
             idf_value = num_documents / df_vector[token_id]
@@ -125,7 +126,9 @@ def main():
                         type=str, help=r"Выходной путь до файла cо значениями TF-IDF. Каждая строка соответствует"
                                        r"одному документу. В строке пробелами разделены пары <термин, его idf, его tf-idf>"
                                        r", а термин и его tf-idf разделены строкой '~~~'")
+    add_profiling_arguments(parser)
     args = parser.parse_args()
+    start_profiling(args)
     input_documents_path = args.input_documents_path
     input_dict_path = args.input_dict_path
     output_df_path = args.output_df_path
@@ -138,18 +141,25 @@ def main():
         os.makedirs(output_dir)
 
     # Подгружаем словарь в память
-    token2id = load_dict(input_dict_path)
-    # Находим инвертированный словарь
-    id2token = {idx: token for token, idx in token2id.items()}
+    with span("load.dict"):
+        token2id = load_dict(input_dict_path)
+    # Находим инвертированный словарь. Компактный словарь возвращает токен по номеру без построения
+    # дополнительной структуры
+    id2token = get_id2token(token2id)
     # Считаем матрицу TF и вектор DF
-    term_frequencies_sparse_matrix, documents_frequencies = get_df_sparse_tf_matrices_from_file(
-        documents_path=input_documents_path, token2id=token2id)
-    tf_idf_sparse_matrix = calculate_sparse_tf_idf_matrix(term_frequencies_sparse_matrix, documents_frequencies)
+    with span("build.tf_matrix"):
+        term_frequencies_sparse_matrix, documents_frequencies = get_df_sparse_tf_matrices_from_file(
+            documents_path=input_documents_path, token2id=token2id)
+    with span("build.tf_idf_matrix"):
+        tf_idf_sparse_matrix = calculate_sparse_tf_idf_matrix(term_frequencies_sparse_matrix, documents_frequencies)
     # Записываем вектор DF (документные частоты терминов) в файл
-    save_df_matrix(save_path=output_df_path, df=documents_frequencies, id2token=id2token)
+    with span("save.df"):
+        save_df_matrix(save_path=output_df_path, df=documents_frequencies, id2token=id2token)
     # Записываем матрицу TF-IDF в файл
-    save_tf_idf_matrix(save_path=output_tf_idf_path, df_vector=documents_frequencies,
-                       tf_idf_sparse_matrix=tf_idf_sparse_matrix, id2token=id2token)
+    with span("save.tf_idf"):
+        save_tf_idf_matrix(save_path=output_tf_idf_path, df_vector=documents_frequencies,
+                           tf_idf_sparse_matrix=tf_idf_sparse_matrix, id2token=id2token)
+    finish_profiling(args)
 
 
 if __name__ == '__main__':
@@ -1,12 +1,224 @@
-import codecs
+import asyncio
+import multiprocessing
 import os
+import queue
+import sys
+import threading
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Awaitable, Callable, Optional
+
+from common.profiling import add_profiling_arguments, finish_profiling, format_stats, merge_stats, \
+    start_profiling, stats_enabled
+from task_3.sharding import load_shards_meta, positive_int, run_task_with_stats, start_shard_workers, \
+    stop_shard_workers
+from task_5.searcher import Searcher, SearchIndexPaths, SearchResult, init_search_worker, search_in_worker, \
+    start_index_watcher
+from task_5.sharded_search import init_vector_shard_worker
+
+# Строка запроса, завершающая сессию
+END_SESSION_REQUEST = '-1'
+# Служебная команда: вывод накопленной статистики без завершения сессии
+STATS_REQUEST = ':stats'
+CONSOLE_PROMPT = "Введите поисковый запрос:\n"
+
+SearchFunction = Callable[[str], Awaitable[SearchResult]]
+
+
+def format_search_result(request_raw_text: str, search_result: SearchResult) -> str:
+    """
+    :param request_raw_text: Строка поискового запроса
+    :param search_result: Ответ на запрос
+    :return: Текст ответа для пользователя
+    """
+    return (f"Строка запроса: {request_raw_text}\n"
+            f"Номер документа - ответа на запрос: {search_result.document_id}\n"
+            f"URL документа - ответа на запрос: {search_result.document_url}\n"
+            f"Текст документа:\n---\n{search_result.document_text}\n---\n\n")
+
+
+def make_thread_search(searcher: Searcher, executor: ThreadPoolExecutor) -> SearchFunction:
+    """
+    :param searcher: Поисковик
+    :param executor: Пул потоков. Из-за GIL лемматизация, k-граммная коррекция и разбор запроса в потоках
+    не выполняются параллельно, одновременно идут только участки numpy/scipy и чтение файлов
+    :return: Корутина поиска, выполняющая запрос в пуле потоков
+    """
+
+    async def search_request(request_raw_text: str) -> SearchResult:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, searcher.search, request_raw_text)
+
+    return search_request
+
+
+def make_process_search(executor: ProcessPoolExecutor) -> SearchFunction:
+    """
+    :param executor: Пул процессов, инициализированных init_search_worker
+    :return: Корутина поиска, выполняющая запрос в процессе-обработчике. Статистика обработчика
+    добавляется в статистику текущего процесса
+    """
+
+    async def search_request(request_raw_text: str) -> SearchResult:
+        loop = asyncio.get_running_loop()
+        collect_stats = stats_enabled()
+        search_result, span_durations, counters = await loop.run_in_executor(
+            executor, run_task_with_stats, search_in_worker, (request_raw_text,), collect_stats)
+        if collect_stats:
+            merge_stats(span_durations, counters)
+        return search_result
+
+    return search_request
+
+
+async def run_session(search_request: SearchFunction, read_request: Callable[[], Awaitable[Optional[str]]],
+                      write_response: Callable[[str], Awaitable[None]]) -> bool:
+    """
+    Обрабатывает запросы одной сессии. Лемматизация и поиск выполняются в пуле,
+    поэтому цикл событий всё это время обслуживает другие сессии
+    :param search_request: Корутина поиска
+    :param read_request: Корутина, возвращающая следующую строку запроса или None в конце ввода
+    :param write_response: Корутина, отправляющая ответ пользователю
+    :return: True, если сессия завершена запросом END_SESSION_REQUEST, False - если закончился ввод
+    """
+    while True:
+        # Принимаем текст запроса пользователя
+        input_request_str = await read_request()
+        if input_request_str is None:
+            return False
+        if input_request_str == END_SESSION_REQUEST:
+            return True
+        if input_request_str == STATS_REQUEST:
+            await write_response(f"{format_stats()}\n")
+            continue
+        try:
+            search_result = await search_request(input_request_str)
+        except Exception as exception:
+            await write_response(f"Ошибка обработки запроса: {exception!r}\n")
+            continue
+        await write_response(format_search_result(input_request_str, search_result))
+
+
+def _read_console(console_requests: queue.Queue):
+    # Консоль читается потоком-демоном напрямую из дескриптора: в отличие от input, он не держит блокировку
+    # sys.stdin, поэтому не мешает завершению процесса по Ctrl+C
+    console_fd = sys.stdin.fileno()
+    buffer = b''
+    while True:
+        loop, line_future = console_requests.get()
+        print(CONSOLE_PROMPT, end='', flush=True)
+        while b'\n' not in buffer:
+            chunk = os.read(console_fd, 4096)
+            if not chunk:
+                break
+            buffer += chunk
+        if buffer:
+            line, _, buffer = buffer.partition(b'\n')
+            line = line.decode(sys.stdin.encoding)
+        else:
+            line = None
+        loop.call_soon_threadsafe(_set_line, line_future, line)
+
+
+def _set_line(line_future: asyncio.Future, line: Optional[str]):
+    if not line_future.done():
+        line_future.set_result(line)
+
+
+async def run_console_session(search_request: SearchFunction, stop_event: asyncio.Event):
+    """
+    Сессия пользователя консоли. Строки консоли читаются потоком-демоном по одной на каждый запрос сессии
+    :param search_request: Корутина поиска
+    :param stop_event: Событие остановки приложения. Устанавливается, если пользователь завершил сессию
+    """
+    loop = asyncio.get_running_loop()
+    console_requests = queue.Queue()
+    threading.Thread(target=_read_console, args=(console_requests,), daemon=True).start()
+
+    async def read_request() -> Optional[str]:
+        line_future = loop.create_future()
+        console_requests.put((loop, line_future))
+        return await line_future
+
+    async def write_response(response: str):
+        print(response, end='')
+
+    if await run_session(search_request, read_request, write_response):
+        stop_event.set()
+
+
+async def serve_tcp_sessions(search_request: SearchFunction, host: str, port: int, stop_event: asyncio.Event):
+    """
+    Принимает TCP-сессии: каждая строка, присланная клиентом, - поисковый запрос в UTF-8
+    :param search_request: Корутина поиска
+    :param host: Адрес, на котором принимаются сессии
+    :param port: Порт, на котором принимаются сессии
+    :param stop_event: Событие остановки приложения
+    """
+    # Открытые соединения: задача обработки соединения и его writer
+    connections = {}
+
+    async def handle_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        connection_task = asyncio.current_task()
+        connections[connection_task] = writer
+
+        async def read_request() -> Optional[str]:
+            line = await reader.readline()
+            return line.decode("utf-8").rstrip('\r\n') if line else None
+
+        async def write_response(response: str):
+            writer.write(response.encode("utf-8"))
+            await writer.drain()
+
+        try:
+            await run_session(search_request, read_request, write_response)
+        except (ConnectionError, asyncio.CancelledError):
+            # Отмена - штатное завершение сессии при остановке приложения. Задача соединения
+            # завершается без исключения: иначе asyncio 3.11 пишет в лог ошибку её обработчика
+            pass
+        finally:
+            connections.pop(connection_task, None)
+            writer.close()
+
+    server = await asyncio.start_server(handle_connection, host=host, port=port)
+    print(f"Поисковые сессии принимаются на {host}:{port}")
+    try:
+        await stop_event.wait()
+    finally:
+        server.close()
+        # wait_closed дожидается закрытия всех соединений, поэтому сессии подключённых клиентов
+        # прерываются, а не обслуживаются до их отключения
+        connection_tasks = list(connections)
+        for connection_task in connection_tasks:
+            connections[connection_task].close()
+            connection_task.cancel()
+        await asyncio.gather(*connection_tasks, return_exceptions=True)
+        await server.wait_closed()
+
+
+async def run_app(search_request: SearchFunction, host: str, port: Optional[int]):
+    """
+    Обслуживает сессию консоли и, если указан порт, одновременно с ней TCP-сессии. Приложение работает,
+    пока пользователь консоли не завершит сессию. Если ввод консоли закончился, TCP-сессии продолжают
+    обслуживаться до прерывания процесса
+    :param search_request: Корутина поиска
+    :param host: Адрес, на котором принимаются TCP-сессии
+    :param port: Порт, на котором принимаются TCP-сессии, или None
+    """
+    stop_event = asyncio.Event()
+    if port is None:
+        await run_console_session(search_request, stop_event)
+    else:
+        await asyncio.gather(run_console_session(search_request, stop_event),
+                             serve_tcp_sessions(search_request, host=host, port=port, stop_event=stop_event))
+
+
+def _cancel_pending_tasks(loop: asyncio.AbstractEventLoop):
+    pending_tasks = asyncio.all_tasks(loop)
+    for task in pending_tasks:
+        task.cancel()
+    loop.run_until_complete(asyncio.gather(*pending_tasks, return_exceptions=True))
 
-from task_3.utils import load_dict
-from task_5.process_request import vectorize_request_tf_idf
-from task_5.utils import load_tf_idf_matrix_from_file, load_vocab_idfs, load_doc_id_url_mapping_from_index
-from natasha import Segmenter, NewsMorphTagger, MorphVocab, NewsEmbedding
-from sklearn.metrics.pairwise import cosine_similarity
 
 def main():
     parser = ArgumentParser()
@@ -24,50 +236,96 @@ def main():
     parser.add_argument('--input_documents_index', default=r"../task_1/reviews/index.txt", type=str,
                         help="Путь к индекс-файлу коллекции, содержащему маппинг номеров"
                              "документов в URL этих документов")
+    parser.add_argument('--input_snapshot_path', default=None, type=str,
+                        help="Путь к слепку индекса, собранному task_5/snapshot.py. Если указан, словарь, DF, "
+                             "TF-IDF и индекс коллекции не читаются из текстовых файлов")
+    parser.add_argument('--input_snapshot_shards_path', default=None, type=str,
+                        help="Путь к файлу описания шардов слепка индекса. Если указан, каждый шард обслуживается "
+                             "своим процессом, запрос в режиме tf_idf выполняется на всех шардах параллельно, "
+                             "а параметр input_snapshot_path не используется")
+    parser.add_argument('--input_kgram_index_path', default=None, type=str,
+                        help="Путь к k-граммному индексу словаря, собранному task_3/kgram_index.py. Если указан, "
+                             "леммы запроса вне словаря заменяются ближайшими леммами словаря")
+    parser.add_argument('--search_mode', default="tf_idf", choices=("tf_idf", "lsa"), type=str,
+                        help="Режим поиска: tf_idf - по разреженным TF-IDF векторам, lsa - по плотным векторам "
+                             "латентно-семантического анализа")
+    parser.add_argument('--input_lsa_index_dir', default=r"lsa_index", type=str,
+                        help="Директория индекса латентно-семантического поиска, собранного task_5/lsa_search.py")
+    parser.add_argument('--num_probes', default=0, type=int,
+                        help="Число просматриваемых кластеров IVF-индекса в режиме lsa. 0 - полный перебор")
+    parser.add_argument('--num_workers', default=4, type=positive_int,
+                        help="Число потоков или процессов, в которых выполняются лемматизация запросов и поиск")
+    parser.add_argument('--executor', default="thread", choices=("thread", "process"), type=str,
+                        help="Пул, в котором выполняются запросы. thread - потоки с общим индексом: из-за GIL "
+                             "лемматизация, k-граммная коррекция и подстановка шаблонов в них выполняются по "
+                             "очереди, параллельны только numpy/scipy и чтение файлов. process - процессы, "
+                             "каждый со своим поисковиком: слепок индекса отображается в память и разделяется "
+                             "процессами, текстовый индекс загружается каждым процессом. С шардами не используется")
+    parser.add_argument('--port', default=None, type=int,
+                        help="Если указан, приложение, помимо сессии консоли, одновременно принимает сессии "
+                             "по TCP на этом порту: каждая строка - поисковый запрос")
+    parser.add_argument('--host', default="127.0.0.1", type=str, help="Адрес, на котором принимаются TCP-сессии")
+    parser.add_argument('--reload_interval', default=2.0, type=float,
+                        help="Интервал проверки файлов индекса, в секундах. При их изменении новая версия индекса "
+                             "загружается в фоне и подменяет текущую. 0 - не проверять. С шардами не используется")
+    add_profiling_arguments(parser)
 
     args = parser.parse_args()
-    input_dict_path = args.input_dict_path
-    input_df_path = args.input_df_path
-    input_tf_idf_path = args.input_tf_idf_path
-    input_raw_documents_dir = args.input_raw_documents_dir
-    input_documents_index = args.input_documents_index
-
-    # Подгружаем словарь в память
-    token2id = load_dict(input_dict_path)
-    # Подгружаем предпосчитанную матрицу TF-IDF из файла
-    tf_idf_matrix = load_tf_idf_matrix_from_file(tf_idf_file_path=input_tf_idf_path, token2id=token2id, )
-    num_documents = tf_idf_matrix.shape[0]
-    # Подгружаем инвертированные документные частоты терминов (IDF)
-    token_idfs = load_vocab_idfs(vocab_dfs_path=input_df_path, token2id=token2id, num_documents=num_documents)
-    doc_id2url = load_doc_id_url_mapping_from_index(input_documents_index)
-
-    segmenter = Segmenter()
-    morph_vocab = MorphVocab()
-    emb = NewsEmbedding()
-    morph_tagger = NewsMorphTagger(emb)
+    start_profiling(args)
 
-    while True:
-        # Принимаем текст запроса пользователя
-        input_request_str = input("Введите поисковый запрос:\n")
-        if input_request_str == '-1':
-            break
-        # Векторизуем запрос в разреженный TF-IDF вектор
-        request_vector = vectorize_request_tf_idf(request_raw_text=input_request_str, segmenter=segmenter,
-                                                  morph_tagger=morph_tagger, morph_vocab=morph_vocab, token2id=token2id,
-                                                  token_idfs=token_idfs)
-        # Идентификатор документа, наиболее похожего на запрос векторно. Мера похожести - косинусная близость векторов
-        response_document_id = cosine_similarity(tf_idf_matrix, request_vector).argmax()
-        # Путь до файла исходного непредобработанного документа
-        response_document_path = os.path.join(input_raw_documents_dir, f"review_{response_document_id}.txt")
-        # Находим URL документа в индекса
-        response_document_url = doc_id2url[response_document_id]
-        with codecs.open(response_document_path, 'r', encoding="utf-8") as raw_text_file:
-            document_text = raw_text_file.read().strip()
-            print(f"Строка запроса: {input_request_str}")
-            print(f"Номер документа - ответа на запрос: {response_document_id}")
-            print(f"URL документа - ответа на запрос: {response_document_url}")
-            print(f"Текст документа:\n---\n{document_text}\n---\n")
+    # Подгружаем словарь, IDF, нормированную матрицу TF-IDF и маппинг номеров документов в URL.
+    # Модели Natasha создаются только при первом запросе, слова которого нет в кэше лемм
+    index_paths = SearchIndexPaths(dict_path=args.input_dict_path, df_path=args.input_df_path,
+                                   tf_idf_path=args.input_tf_idf_path,
+                                   documents_index_path=args.input_documents_index,
+                                   snapshot_path=args.input_snapshot_path,
+                                   kgram_index_path=args.input_kgram_index_path,
+                                   lsa_index_dir=args.input_lsa_index_dir if args.search_mode == "lsa" else None)
+    shard_pools = None
+    shards_snapshot_path = None
+    if args.input_snapshot_shards_path is not None:
+        if args.executor == "process":
+            parser.error("--executor process не используется с --input_snapshot_shards_path")
+        shards_meta = load_shards_meta(args.input_snapshot_shards_path)
+        shard_pools = start_shard_workers(init_vector_shard_worker, [(shard_path, first_doc_id)
+                                                                     for shard_path, first_doc_id, _ in shards_meta])
+        # Словарь, IDF и кэш лемм одинаковы во всех шардах, поэтому для векторизации запросов берём их из первого
+        shards_snapshot_path = shards_meta[0][0]
+    stop_watcher_event = None
+    if args.executor == "process":
+        # Процессы запускаются заново, а не копированием текущего: к моменту их создания уже работают потоки
+        # чтения консоли и цикла событий, блокировки которых не должны попасть в процессы-обработчики
+        executor = ProcessPoolExecutor(max_workers=args.num_workers, mp_context=multiprocessing.get_context("spawn"),
+                                       initializer=init_search_worker,
+                                       initargs=(index_paths, args.input_raw_documents_dir, args.search_mode,
+                                                 args.num_probes, args.reload_interval))
+        search_request = make_process_search(executor)
+    else:
+        searcher = Searcher(index_paths, raw_documents_dir=args.input_raw_documents_dir,
+                            search_mode=args.search_mode, num_probes=args.num_probes, shard_pools=shard_pools,
+                            shards_snapshot_path=shards_snapshot_path)
+        if args.reload_interval > 0 and shard_pools is None:
+            stop_watcher_event = start_index_watcher(searcher, check_interval=args.reload_interval)
+        executor = ThreadPoolExecutor(max_workers=args.num_workers)
+        search_request = make_thread_search(searcher, executor)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(run_app(search_request, host=args.host, port=args.port))
+    except KeyboardInterrupt:
+        # Запросы, ещё стоящие в очереди пула, не выполняем
+        executor.shutdown(wait=False, cancel_futures=True)
+    finally:
+        _cancel_pending_tasks(loop)
+        loop.close()
+        executor.shutdown()
+        if stop_watcher_event is not None:
+            stop_watcher_event.set()
+        if shard_pools is not None:
+            stop_shard_workers(shard_pools)
+    finish_profiling(args)
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
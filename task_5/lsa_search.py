@@ -0,0 +1,279 @@
+import codecs
+import os
+from argparse import ArgumentParser
+from typing import Dict, Mapping, NamedTuple, Optional, Tuple, TYPE_CHECKING
+
+import numpy as np
+
+from common.profiling import add_profiling_arguments, finish_profiling, increment, span, start_profiling
+from common.utils import replacing_file
+from task_3.utils import load_dict
+from task_3.vocabulary import get_vocabulary_fingerprint
+from task_5.utils import load_tf_idf_matrix_from_file
+
+if TYPE_CHECKING:
+    from scipy.sparse import csr_matrix
+
+TERM_PROJECTIONS_FNAME = "term_projections.npy"
+DOCUMENT_EMBEDDINGS_FNAME = "document_embeddings.npy"
+CLUSTER_CENTROIDS_FNAME = "cluster_centroids.npy"
+CLUSTER_INDPTR_FNAME = "cluster_indptr.npy"
+CLUSTER_DOC_IDS_FNAME = "cluster_doc_ids.npy"
+# Отпечаток словаря, по которому построен индекс (см. get_vocabulary_fingerprint)
+VOCABULARY_FINGERPRINT_FNAME = "vocabulary_fingerprint.txt"
+
+
+class LsaIndex(NamedTuple):
+    """
+    Индекс латентно-семантического поиска:
+    term_projections - матрица размера (размер словаря, размерность LSA): строка t - проекция
+    термина с идентификатором t в латентное пространство (транспонированные компоненты SVD);
+    document_embeddings - L2-нормированные плотные векторы документов размера (число документов,
+    размерность LSA);
+    cluster_centroids, cluster_indptr, cluster_doc_ids - необязательный IVF-индекс: центроиды
+    кластеров документов и номера документов кластера c в cluster_doc_ids[cluster_indptr[c]:cluster_indptr[c + 1]];
+    vocabulary_fingerprint - отпечаток словаря, по которому построен индекс. Заполняется load_lsa_index
+    """
+    term_projections: np.ndarray
+    document_embeddings: np.ndarray
+    cluster_centroids: Optional[np.ndarray] = None
+    cluster_indptr: Optional[np.ndarray] = None
+    cluster_doc_ids: Optional[np.ndarray] = None
+    vocabulary_fingerprint: Optional[str] = None
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def build_lsa_index(tf_idf_matrix: "csr_matrix", num_components: int, num_clusters: int = 0,
+                    random_state: int = 42) -> LsaIndex:
+    """
+    Строит индекс латентно-семантического поиска рандомизированным усечённым SVD матрицы TF-IDF
+    :param tf_idf_matrix: Разреженная TF-IDF матрица документов коллекции
+    :param num_components: Размерность латентного пространства. Ограничивается сверху
+    размерами матрицы
+    :param num_clusters: Число кластеров IVF-индекса. 0 - IVF-индекс не строится
+    :param random_state: Зерно генератора случайных чисел SVD и k-means
+    :return: Индекс латентно-семантического поиска
+    """
+    from sklearn.cluster import KMeans
+    from sklearn.decomposition import TruncatedSVD
+    from sklearn.preprocessing import normalize
+
+    num_components = min(num_components, min(tf_idf_matrix.shape) - 1)
+    svd = TruncatedSVD(n_components=num_components, algorithm="randomized", random_state=random_state)
+    document_embeddings = svd.fit_transform(normalize(tf_idf_matrix, norm="l2", axis=1))
+    document_embeddings = _normalize_rows(document_embeddings).astype(np.float32)
+    term_projections = np.ascontiguousarray(svd.components_.T, dtype=np.float32)
+    if num_clusters <= 0:
+        return LsaIndex(term_projections=term_projections, document_embeddings=document_embeddings)
+
+    num_clusters = min(num_clusters, document_embeddings.shape[0])
+    kmeans = KMeans(n_clusters=num_clusters, random_state=random_state, n_init=10).fit(document_embeddings)
+    cluster_centroids = _normalize_rows(kmeans.cluster_centers_).astype(np.float32)
+    # Упорядочиваем документы по кластерам, чтобы документы одного кластера шли подряд
+    cluster_doc_ids = np.argsort(kmeans.labels_, kind="stable").astype(np.int32)
+    cluster_sizes = np.bincount(kmeans.labels_, minlength=num_clusters)
+    cluster_indptr = np.concatenate(([0], np.cumsum(cluster_sizes))).astype(np.int64)
+    return LsaIndex(term_projections=term_projections, document_embeddings=document_embeddings,
+                    cluster_centroids=cluster_centroids, cluster_indptr=cluster_indptr,
+                    cluster_doc_ids=cluster_doc_ids)
+
+
+def _save_array(array_path: str, array: np.ndarray):
+    # Записываем под временным именем и атомарно переименовываем: уже отображённый в память файл не меняется
+    temporary_array_path = f"{array_path}.tmp"
+    with open(temporary_array_path, "wb") as array_file:
+        np.save(array_file, array)
+    os.replace(temporary_array_path, array_path)
+
+
+def save_lsa_index(lsa_index_dir: str, lsa_index: LsaIndex, vocabulary_fingerprint: str):
+    """
+    Сохраняет массивы индекса латентно-семантического поиска в .npy файлы директории lsa_index_dir
+    и отпечаток словаря, по которому индекс построен
+    :param lsa_index_dir: Выходная директория индекса
+    :param lsa_index: Индекс латентно-семантического поиска
+    :param vocabulary_fingerprint: Отпечаток словаря, возвращённый get_vocabulary_fingerprint
+    """
+    if not os.path.exists(lsa_index_dir) and lsa_index_dir != '':
+        os.makedirs(lsa_index_dir)
+    _save_array(os.path.join(lsa_index_dir, TERM_PROJECTIONS_FNAME), lsa_index.term_projections)
+    _save_array(os.path.join(lsa_index_dir, DOCUMENT_EMBEDDINGS_FNAME), lsa_index.document_embeddings)
+    if lsa_index.cluster_centroids is not None:
+        _save_array(os.path.join(lsa_index_dir, CLUSTER_CENTROIDS_FNAME), lsa_index.cluster_centroids)
+        _save_array(os.path.join(lsa_index_dir, CLUSTER_INDPTR_FNAME), lsa_index.cluster_indptr)
+        _save_array(os.path.join(lsa_index_dir, CLUSTER_DOC_IDS_FNAME), lsa_index.cluster_doc_ids)
+    else:
+        # IVF-индекс предыдущей сборки не соответствует новым векторам документов
+        for fname in (CLUSTER_CENTROIDS_FNAME, CLUSTER_INDPTR_FNAME, CLUSTER_DOC_IDS_FNAME):
+            if os.path.exists(os.path.join(lsa_index_dir, fname)):
+                os.remove(os.path.join(lsa_index_dir, fname))
+    # Отпечаток записывается последним: пока он старый, индекс не пройдёт проверку check_lsa_index_vocabulary
+    with replacing_file(os.path.join(lsa_index_dir, VOCABULARY_FINGERPRINT_FNAME)) as temporary_path, \
+            codecs.open(temporary_path, 'w+', encoding="utf-8") as fingerprint_file:
+        fingerprint_file.write(f"{vocabulary_fingerprint}\n")
+
+
+def load_lsa_index(lsa_index_dir: str) -> LsaIndex:
+    """
+    Отображает в память массивы индекса латентно-семантического поиска
+    :param lsa_index_dir: Директория индекса, сохранённого save_lsa_index
+    :return: Индекс латентно-семантического поиска
+    """
+    arrays = {}
+    for field_name, fname in (("term_projections", TERM_PROJECTIONS_FNAME),
+                              ("document_embeddings", DOCUMENT_EMBEDDINGS_FNAME)):
+        array_path = os.path.join(lsa_index_dir, fname)
+        if not os.path.exists(array_path):
+            raise FileNotFoundError(f"LSA index file {array_path} not found. Build the index with "
+                                    f"task_5/lsa_search.py --output_lsa_index_dir {lsa_index_dir}")
+        arrays[field_name] = np.load(array_path, mmap_mode='r')
+    cluster_array_paths = {field_name: os.path.join(lsa_index_dir, fname)
+                           for field_name, fname in (("cluster_centroids", CLUSTER_CENTROIDS_FNAME),
+                                                     ("cluster_indptr", CLUSTER_INDPTR_FNAME),
+                                                     ("cluster_doc_ids", CLUSTER_DOC_IDS_FNAME))}
+    # IVF-индекс необязателен, но используется только целиком
+    if all(os.path.exists(array_path) for array_path in cluster_array_paths.values()):
+        for field_name, array_path in cluster_array_paths.items():
+            arrays[field_name] = np.load(array_path, mmap_mode='r')
+    fingerprint_path = os.path.join(lsa_index_dir, VOCABULARY_FINGERPRINT_FNAME)
+    if not os.path.exists(fingerprint_path):
+        raise FileNotFoundError(f"LSA index file {fingerprint_path} not found. Rebuild the index with "
+                                f"task_5/lsa_search.py --output_lsa_index_dir {lsa_index_dir}")
+    with codecs.open(fingerprint_path, 'r', encoding="utf-8") as fingerprint_file:
+        vocabulary_fingerprint = fingerprint_file.read().strip()
+    return LsaIndex(vocabulary_fingerprint=vocabulary_fingerprint, **arrays)
+
+
+def check_lsa_index_vocabulary(lsa_index: LsaIndex, token2id: Mapping[str, int]):
+    """
+    Проверяет, что индекс латентно-семантического поиска построен по словарю token2id. Номера терминов
+    меняются при каждой пересборке словаря, и индекс от другого словаря даёт неверные векторы запросов
+    :param lsa_index: Индекс, загруженный load_lsa_index
+    :param token2id: Словарь, по которому векторизуются запросы
+    """
+    if lsa_index.term_projections.shape[0] != len(token2id):
+        raise ValueError(f"LSA index has {lsa_index.term_projections.shape[0]} term projections, but the vocabulary "
+                         f"has {len(token2id)} terms. Rebuild the index with task_5/lsa_search.py")
+    if lsa_index.vocabulary_fingerprint != get_vocabulary_fingerprint(token2id):
+        raise ValueError("LSA index was built for another vocabulary. Rebuild the index with task_5/lsa_search.py")
+
+
+def embed_request(lsa_index: LsaIndex, term_weights: Dict[int, float]) -> np.ndarray:
+    """
+    Проецирует TF-IDF вектор запроса в латентное пространство
+    :param lsa_index: Индекс латентно-семантического поиска
+    :param term_weights: Словарь {номер термина в словаре : TF-IDF вес термина в запросе}
+    :return: L2-нормированный плотный вектор запроса размера (размерность LSA)
+    """
+    request_embedding = np.zeros(lsa_index.term_projections.shape[1], dtype=np.float32)
+    for token_id, weight in term_weights.items():
+        request_embedding += weight * lsa_index.term_projections[token_id]
+    norm = np.linalg.norm(request_embedding)
+    if norm > 0:
+        request_embedding /= norm
+    return request_embedding
+
+
+def _merge_top_k(top_doc_ids: np.ndarray, top_scores: np.ndarray, doc_ids: np.ndarray, scores: np.ndarray,
+                 k: int) -> Tuple[np.ndarray, np.ndarray]:
+    doc_ids = np.concatenate((top_doc_ids, doc_ids))
+    scores = np.concatenate((top_scores, scores))
+    if scores.shape[0] > k:
+        top_positions = np.argpartition(-scores, k - 1)[:k]
+        doc_ids, scores = doc_ids[top_positions], scores[top_positions]
+    return doc_ids, scores
+
+
+def _sort_by_score(doc_ids: np.ndarray, scores: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    order = np.argsort(-scores, kind="stable")
+    return doc_ids[order], scores[order]
+
+
+def search_top_k(document_embeddings: np.ndarray, request_embedding: np.ndarray, k: int,
+                 block_size: int = 65536) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Находит k документов с наибольшей косинусной близостью к запросу полным перебором.
+    Матрица векторов документов умножается на вектор запроса блоками по block_size строк,
+    чтобы блок и промежуточные оценки помещались в кэш процессора
+    :param document_embeddings: L2-нормированные векторы документов
+    :param request_embedding: L2-нормированный вектор запроса
+    :param k: Число возвращаемых документов
+    :param block_size: Число документов в блоке
+    :return: Номера документов и их оценки близости в порядке убывания оценки
+    """
+    top_doc_ids = np.empty(0, dtype=np.int64)
+    top_scores = np.empty(0, dtype=np.float32)
+    for block_start in range(0, document_embeddings.shape[0], block_size):
+        block_scores = document_embeddings[block_start:block_start + block_size] @ request_embedding
+        block_doc_ids = np.arange(block_start, block_start + block_scores.shape[0])
+        top_doc_ids, top_scores = _merge_top_k(top_doc_ids, top_scores, block_doc_ids, block_scores, k)
+    increment("dense_documents_scored", document_embeddings.shape[0])
+    return _sort_by_score(top_doc_ids, top_scores)
+
+
+def search_top_k_ivf(lsa_index: LsaIndex, request_embedding: np.ndarray, k: int,
+                     num_probes: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Находит k документов, близких к запросу, просматривая только документы num_probes кластеров
+    с ближайшими к запросу центроидами. Результат приближённый: документ из непросмотренного
+    кластера может оказаться ближе найденных. Если IVF-индекс не построен, выполняется полный перебор
+    :param lsa_index: Индекс латентно-семантического поиска
+    :param request_embedding: L2-нормированный вектор запроса
+    :param k: Число возвращаемых документов
+    :param num_probes: Число просматриваемых кластеров
+    :return: Номера документов и их оценки близости в порядке убывания оценки
+    """
+    if lsa_index.cluster_centroids is None or num_probes <= 0:
+        return search_top_k(lsa_index.document_embeddings, request_embedding, k=k)
+    centroid_scores = lsa_index.cluster_centroids @ request_embedding
+    num_probes = min(num_probes, centroid_scores.shape[0])
+    probed_clusters = np.argpartition(-centroid_scores, num_probes - 1)[:num_probes]
+    top_doc_ids = np.empty(0, dtype=np.int64)
+    top_scores = np.empty(0, dtype=np.float32)
+    for cluster_id in probed_clusters:
+        start, end = lsa_index.cluster_indptr[cluster_id], lsa_index.cluster_indptr[cluster_id + 1]
+        doc_ids = lsa_index.cluster_doc_ids[start:end].astype(np.int64)
+        scores = lsa_index.document_embeddings[doc_ids] @ request_embedding
+        increment("dense_documents_scored", int(end - start))
+        top_doc_ids, top_scores = _merge_top_k(top_doc_ids, top_scores, doc_ids, scores, k)
+    return _sort_by_score(top_doc_ids, top_scores)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--input_dict_path', default=r"../task_2/tokenized_texts/dict.txt", type=str,
+                        help="Путь к словарю")
+    parser.add_argument('--input_tf_idf_path', default="../task_4/tf_idf/tf_idf.txt",
+                        type=str, help=r"Путь до файла cо значениями TF-IDF")
+    parser.add_argument('--num_components', default=300, type=int,
+                        help="Размерность латентного пространства LSA")
+    parser.add_argument('--num_clusters', default=0, type=int,
+                        help="Число кластеров IVF-индекса для приближённого поиска. 0 - не строить IVF-индекс")
+    parser.add_argument('--output_lsa_index_dir', default=r"lsa_index", type=str,
+                        help="Выходная директория индекса латентно-семантического поиска")
+    add_profiling_arguments(parser)
+    args = parser.parse_args()
+    start_profiling(args)
+
+    # Подгружаем словарь в память
+    with span("load.dict"):
+        token2id = load_dict(args.input_dict_path)
+    # Подгружаем предпосчитанную матрицу TF-IDF из файла
+    with span("load.tf_idf"):
+        tf_idf_matrix = load_tf_idf_matrix_from_file(tf_idf_file_path=args.input_tf_idf_path, token2id=token2id, )
+    with span("build.lsa_index"):
+        lsa_index = build_lsa_index(tf_idf_matrix, num_components=args.num_components,
+                                    num_clusters=args.num_clusters)
+    with span("save.lsa_index"):
+        save_lsa_index(args.output_lsa_index_dir, lsa_index,
+                       vocabulary_fingerprint=get_vocabulary_fingerprint(token2id))
+    finish_profiling(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,21 +1,76 @@
 import codecs
 import os
+import re
 from argparse import ArgumentParser
 from collections import Counter
-from typing import Dict
+from typing import Dict, List, Optional, Sequence, Union, TYPE_CHECKING
 
-from natasha import Segmenter, NewsMorphTagger, MorphVocab, NewsEmbedding
-from scipy.sparse import csr_matrix
-from sklearn.metrics.pairwise import cosine_similarity
+from task_2.code.task_2 import get_lemmatized_doc, load_natasha_models
+from task_3.kgram_index import KGramIndex, find_closest_term_id, load_kgram_index
+from common.profiling import add_profiling_arguments, finish_profiling, increment, span, start_profiling
+from task_5.snapshot import load_or_build_index_snapshot, score_documents
 
-from task_2.code.task_2 import get_lemmatized_doc
-from task_3.utils import load_dict
-from task_5.utils import load_tf_idf_matrix_from_file, load_vocab_idfs
+if TYPE_CHECKING:
+    from natasha import Segmenter, NewsMorphTagger, MorphVocab
+    from scipy.sparse import csr_matrix
 
+# Слово запроса для поиска в кэше лемм: последовательность букв и цифр, возможно, через дефис
+WORD_PATTERN = re.compile(r"\w+(?:-\w+)*")
 
-def vectorize_request_tf_idf(request_raw_text: str, segmenter: Segmenter, morph_tagger: NewsMorphTagger,
-                             morph_vocab: MorphVocab, token2id: Dict[str, int],
-                             token_idfs: Dict[int, float]) -> csr_matrix:
+
+def lemmatize_request(request_raw_text: str, lemma_cache: Dict[str, str]) -> List[str]:
+    """
+    Лемматизирует строку запроса. Если все слова запроса есть в кэше лемм, леммы берутся из
+    него, и модели Natasha не загружаются. Иначе запрос лемматизируется моделями Natasha,
+    которые создаются при первом таком запросе
+    :param request_raw_text: Непредобработанная строка поискового запроса
+    :param lemma_cache: Словарь {слово в нижнем регистре : лемма}
+    :return: Список лемм слов запроса
+    """
+    with span("lemmatize"):
+        words = [word.lower() for word in WORD_PATTERN.findall(request_raw_text)]
+        if lemma_cache and all(word in lemma_cache for word in words):
+            increment("lemma_cache_hits")
+            return [lemma_cache[word] for word in words]
+        segmenter, morph_tagger, morph_vocab = load_natasha_models()
+        return get_lemmatized_doc(raw_text=request_raw_text, segmenter=segmenter, morph_tagger=morph_tagger,
+                                  morph_vocab=morph_vocab)
+
+
+def get_request_tf_idf_weights(lemmatized_tokens: List[str], token2id: Dict[str, int],
+                               token_idfs: Union[Dict[int, float], Sequence[float]],
+                               kgram_index: Optional[KGramIndex] = None) -> Dict[int, float]:
+    """
+    :param lemmatized_tokens: Список лемм запроса
+    :param token2id: Словарь: маппинг из термина в идентификатор слова в словаре
+    :param token_idfs: Маппинг из номера термина в словаре в его значение IDF: словарь или
+    вектор IDF, индексируемый номером термина
+    :param kgram_index: k-граммный индекс словаря для исправления терминов вне словаря
+    :return: Словарь {номер термина в словаре : TF-IDF вес термина в запросе}. Термины,
+    отсутствующие в словаре, заменяются ближайшими терминами словаря, если передан k-граммный
+    индекс, иначе отбрасываются
+    """
+    # Превращаем список слов в список номеров слов в словаре
+    token_ids_list = []
+    for token in lemmatized_tokens:
+        token_id = token2id.get(token)
+        if token_id is not None:
+            token_ids_list.append(token_id)
+            continue
+        increment("request_lemmas_out_of_vocab")
+        closest_term_id = find_closest_term_id(kgram_index, token) if kgram_index is not None else None
+        if closest_term_id is not None:
+            token_ids_list.append(closest_term_id)
+    increment("request_lemmas", len(lemmatized_tokens))
+    # Подсчитываем частоты слов в документе
+    request_tf = Counter(token_ids_list)
+    # Подсчитываем TF-IDF каждого слова в документе
+    return {token_id: token_tf * float(token_idfs[token_id]) for token_id, token_tf in request_tf.items()}
+
+
+def vectorize_request_tf_idf(request_raw_text: str, segmenter: "Segmenter", morph_tagger: "NewsMorphTagger",
+                             morph_vocab: "MorphVocab", token2id: Dict[str, int],
+                             token_idfs: Dict[int, float]) -> "csr_matrix":
     """
     :param request_raw_text: Непредобработанная строка поискового запроса
     :param segmenter: Токенизатор библиотеки Natasha
@@ -27,24 +82,17 @@ def vectorize_request_tf_idf(request_raw_text: str, segmenter: Segmenter, morph_
     :param token_idfs: Словарь: маппинг из номера термина в словаре в его значение IDF
     :return: Разреженный TF-IDF вектор запроса
     """
-    vocab_size = len(token_idfs.keys())
-    # Токенизируем и лемматизируем документ
-    lemmatized_tokens = get_lemmatized_doc(raw_text=request_raw_text, segmenter=segmenter,
-                                           morph_tagger=morph_tagger, morph_vocab=morph_vocab)
+    from scipy.sparse import csr_matrix
 
-    # Превращаем список слов в список номеров слов в словаре
-    token_ids_list = [token2id[token] for token in lemmatized_tokens if token in token2id.keys()]
-    # Подсчитываем частоты слов в документе
-    request_tf = Counter(token_ids_list)
-    tf_idf_vector_col_indices = []
-    tf_idf_vector_values = []
-    # Подсчитываем TF-IDF каждого слова в документе
-    for token_id, token_tf in request_tf.items():
-        tf_idf_vector_col_indices.append(token_id)
-        token_idf = token_idfs[token_id]
-        tf_idf_vector_values.append(token_tf * token_idf)
+    vocab_size = len(token2id)
+    # Токенизируем и лемматизируем документ
+    with span("lemmatize"):
+        lemmatized_tokens = get_lemmatized_doc(raw_text=request_raw_text, segmenter=segmenter,
+                                               morph_tagger=morph_tagger, morph_vocab=morph_vocab)
+    request_tf_idf_weights = get_request_tf_idf_weights(lemmatized_tokens, token2id=token2id, token_idfs=token_idfs)
+    tf_idf_vector_col_indices = list(request_tf_idf_weights.keys())
+    tf_idf_vector_values = list(request_tf_idf_weights.values())
     tf_idf_vector_row_indices = [0] * len(tf_idf_vector_col_indices)
-    assert len(tf_idf_vector_col_indices) == len(tf_idf_vector_values)
     # Создаём TF-IDF вектор документа как разреженный вектор
     request_sparse_tf_idf_vector = csr_matrix(
         (tf_idf_vector_values, (tf_idf_vector_row_indices, tf_idf_vector_col_indices)),
@@ -84,41 +132,50 @@ def main():
                                        r"а термин и его tf-idf разделены строкой '~~~'")
     parser.add_argument('--input_raw_documents_dir', default=r"../task_1/reviews/reviews/", type=str,
                         help="Путь к директории непредобработанных документов")
+    parser.add_argument('--input_snapshot_path', default=None, type=str,
+                        help="Путь к слепку индекса, собранному task_5/snapshot.py. Если указан, словарь, DF "
+                             "и TF-IDF не читаются из текстовых файлов")
+    parser.add_argument('--input_kgram_index_path', default=None, type=str,
+                        help="Путь к k-граммному индексу словаря, собранному task_3/kgram_index.py. Если указан, "
+                             "леммы запроса вне словаря заменяются ближайшими леммами словаря")
     parser.add_argument('--output_log_path', default=r"search_log.txt", type=str,
                         help="Путь к файлу логов поисковых запросов")
+    add_profiling_arguments(parser)
     args = parser.parse_args()
+    start_profiling(args)
     input_request_str = args.input_request_str
     input_dict_path = args.input_dict_path
     input_df_path = args.input_df_path
     input_tf_idf_path = args.input_tf_idf_path
     input_raw_documents_dir = args.input_raw_documents_dir
+    input_snapshot_path = args.input_snapshot_path
     output_log_path = args.output_log_path
     output_dir = os.path.dirname(output_log_path)
     if not os.path.exists(output_dir) and output_dir != '':
         os.makedirs(output_dir)
 
-    # Подгружаем словарь в память
-    token2id = load_dict(input_dict_path)
-    # Подгружаем предпосчитанную матрицу TF-IDF из файла
-    tf_idf_matrix = load_tf_idf_matrix_from_file(tf_idf_file_path=input_tf_idf_path, token2id=token2id, )
-    num_documents = tf_idf_matrix.shape[0]
-    # Подгружаем инвертированные документные частоты терминов (IDF)
-    token_idfs = load_vocab_idfs(vocab_dfs_path=input_df_path, token2id=token2id, num_documents=num_documents)
-
-    segmenter = Segmenter()
-    morph_vocab = MorphVocab()
-    emb = NewsEmbedding()
-    morph_tagger = NewsMorphTagger(emb)
-    request_vector = vectorize_request_tf_idf(request_raw_text=input_request_str, segmenter=segmenter,
-                                              morph_tagger=morph_tagger, morph_vocab=morph_vocab, token2id=token2id,
-                                              token_idfs=token_idfs)
+    # Подгружаем словарь, IDF и нормированную матрицу TF-IDF
+    snapshot = load_or_build_index_snapshot(snapshot_path=input_snapshot_path, dict_path=input_dict_path,
+                                            df_path=input_df_path, tf_idf_path=input_tf_idf_path,
+                                            documents_index_path=None)
+    kgram_index = None
+    if args.input_kgram_index_path is not None:
+        with span("load.kgram_index"):
+            kgram_index = load_kgram_index(args.input_kgram_index_path, snapshot.token2id)
+    lemmatized_tokens = lemmatize_request(input_request_str, lemma_cache=snapshot.lemma_cache)
+    with span("vectorize"):
+        request_tf_idf_weights = get_request_tf_idf_weights(lemmatized_tokens, token2id=snapshot.token2id,
+                                                            token_idfs=snapshot.idf_vector, kgram_index=kgram_index)
     # Идентификатор документа, наиболее похожего на запрос векторно. Мера похожести - косинусная близость векторов
-    response_document_id = cosine_similarity(tf_idf_matrix, request_vector).argmax()
+    with span("cosine_similarity"):
+        response_document_id = int(score_documents(snapshot, request_tf_idf_weights).argmax())
     # Путь до файла исходного непредобработанного документа
     response_document_path = os.path.join(input_raw_documents_dir, f"review_{response_document_id}.txt")
     # Логируем результат выполнения запроса
-    write_request_log(log_file_path=output_log_path, request_str=input_request_str,
-                      response_document_id=response_document_id, response_document_path=response_document_path)
+    with span("write_log"):
+        write_request_log(log_file_path=output_log_path, request_str=input_request_str,
+                          response_document_id=response_document_id, response_document_path=response_document_path)
+    finish_profiling(args)
 
 
 if __name__ == '__main__':
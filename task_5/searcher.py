@@ -0,0 +1,285 @@
+import codecs
+import os
+import signal
+import threading
+import traceback
+from multiprocessing.pool import Pool
+from typing import List, NamedTuple, Optional, Tuple
+
+from task_3.kgram_index import KGramIndex, load_kgram_index
+from common.profiling import increment, span
+from task_5.lsa_search import LsaIndex, VOCABULARY_FINGERPRINT_FNAME, check_lsa_index_vocabulary, embed_request, \
+    load_lsa_index, search_top_k, search_top_k_ivf
+from task_5.process_request import get_request_tf_idf_weights, lemmatize_request
+from task_5.sharded_search import get_sharded_doc_id2url, search_vector_shards
+from task_5.snapshot import IndexSnapshot, load_or_build_index_snapshot, score_documents
+
+# Состояние процесса-обработчика запросов: собственный поисковик процесса
+_worker_state = {}
+
+
+class SearchIndexPaths(NamedTuple):
+    """
+    Пути к файлам, из которых собирается индекс поиска. Если snapshot_path задан, словарь, DF,
+    TF-IDF и индекс коллекции не читаются. kgram_index_path и lsa_index_dir необязательны
+    """
+    dict_path: str
+    df_path: str
+    tf_idf_path: str
+    documents_index_path: str
+    snapshot_path: Optional[str] = None
+    kgram_index_path: Optional[str] = None
+    lsa_index_dir: Optional[str] = None
+
+
+class SearchIndex(NamedTuple):
+    """
+    Неизменяемая версия индекса поиска. Запрос берёт ссылку на текущую версию один раз и
+    выполняется целиком по ней, поэтому замена версии не влияет на уже выполняющиеся запросы:
+    snapshot - слепок векторного индекса;
+    kgram_index - k-граммный индекс словаря слепка или None;
+    lsa_index - индекс латентно-семантического поиска или None;
+    version - номер версии индекса, начиная с 1;
+    files_version - состояние файлов индекса на момент загрузки (см. get_files_version)
+    """
+    snapshot: IndexSnapshot
+    kgram_index: Optional[KGramIndex]
+    lsa_index: Optional[LsaIndex]
+    version: int
+    files_version: Tuple
+
+
+class SearchResult(NamedTuple):
+    document_id: int
+    document_url: str
+    document_text: str
+    index_version: int
+
+
+def get_index_file_paths(index_paths: SearchIndexPaths) -> List[str]:
+    """
+    :param index_paths: Пути к файлам индекса поиска
+    :return: Пути ко всем файлам, изменение которых означает появление новой версии индекса
+    """
+    if index_paths.snapshot_path is not None:
+        file_paths = [index_paths.snapshot_path]
+    else:
+        file_paths = [index_paths.dict_path, index_paths.df_path, index_paths.tf_idf_path,
+                      index_paths.documents_index_path]
+    if index_paths.kgram_index_path is not None:
+        file_paths.append(index_paths.kgram_index_path)
+    if index_paths.lsa_index_dir is not None and os.path.isdir(index_paths.lsa_index_dir):
+        file_paths.extend(os.path.join(index_paths.lsa_index_dir, fname)
+                          for fname in sorted(os.listdir(index_paths.lsa_index_dir))
+                          if fname.endswith(".npy") or fname == VOCABULARY_FINGERPRINT_FNAME)
+    return file_paths
+
+
+def get_files_version(file_paths: List[str]) -> Tuple:
+    """
+    :param file_paths: Пути к файлам
+    :return: Кортеж (путь, размер, время изменения) по всем файлам. Отсутствующие файлы имеют размер -1
+    """
+    files_version = []
+    for file_path in file_paths:
+        try:
+            file_stat = os.stat(file_path)
+            files_version.append((file_path, file_stat.st_size, file_stat.st_mtime_ns))
+        except FileNotFoundError:
+            files_version.append((file_path, -1, -1))
+    return tuple(files_version)
+
+
+def load_search_index(index_paths: SearchIndexPaths, version: int) -> SearchIndex:
+    """
+    :param index_paths: Пути к файлам индекса поиска
+    :param version: Номер загружаемой версии индекса
+    :return: Загруженная версия индекса поиска
+    """
+    # Состояние файлов запоминается до чтения: если файлы изменятся во время загрузки, следующая проверка это заметит
+    files_version = get_files_version(get_index_file_paths(index_paths))
+    snapshot = load_or_build_index_snapshot(snapshot_path=index_paths.snapshot_path, dict_path=index_paths.dict_path,
+                                            df_path=index_paths.df_path, tf_idf_path=index_paths.tf_idf_path,
+                                            documents_index_path=index_paths.documents_index_path)
+    kgram_index = None
+    if index_paths.kgram_index_path is not None:
+        with span("load.kgram_index"):
+            kgram_index = load_kgram_index(index_paths.kgram_index_path, snapshot.token2id)
+    lsa_index = None
+    if index_paths.lsa_index_dir is not None:
+        with span("load.lsa_index"):
+            lsa_index = load_lsa_index(index_paths.lsa_index_dir)
+        # Слепок и индекс LSA пересобираются разными этапами: версия, в которой они построены
+        # по разным словарям, не загружается, и поиск продолжается по предыдущей версии
+        check_lsa_index_vocabulary(lsa_index, snapshot.token2id)
+    return SearchIndex(snapshot=snapshot, kgram_index=kgram_index, lsa_index=lsa_index, version=version,
+                       files_version=files_version)
+
+
+class Searcher:
+    """
+    Потокобезопасный поисковик: отвечает на запросы по текущей неизменяемой версии индекса
+    и атомарно заменяет её на новую. Метод search можно вызывать из нескольких потоков
+    одновременно; загрузка новой версии выполняется вне блокировки и не задерживает запросы
+    """
+
+    def __init__(self, index_paths: SearchIndexPaths, raw_documents_dir: str, search_mode: str = "tf_idf",
+                 num_probes: int = 0, shard_pools: Optional[List[Pool]] = None, shards_snapshot_path: str = None):
+        """
+        :param index_paths: Пути к файлам индекса поиска
+        :param raw_documents_dir: Путь к директории непредобработанных документов
+        :param search_mode: tf_idf - поиск по разреженным TF-IDF векторам, lsa - по плотным векторам LSA
+        :param num_probes: Число просматриваемых кластеров IVF-индекса в режиме lsa. 0 - полный перебор
+        :param shard_pools: Пулы процессов-обработчиков шардов слепка или None. Шарды загружаются
+        обработчиками один раз, поэтому с ними индекс не обновляется
+        :param shards_snapshot_path: Путь к слепку первого шарда, из которого берутся словарь, IDF и кэш лемм
+        """
+        if shard_pools is not None:
+            index_paths = index_paths._replace(snapshot_path=shards_snapshot_path)
+        self.index_paths = index_paths
+        self.raw_documents_dir = raw_documents_dir
+        self.search_mode = search_mode
+        self.num_probes = num_probes
+        self.shard_pools = shard_pools
+        # Слепок первого шарда знает URL только своих документов, а в режиме lsa документ
+        # из любого шарда находится в текущем процессе, поэтому URL всех шардов собираются заранее
+        self._sharded_doc_id2url = None
+        if shard_pools is not None and search_mode == "lsa":
+            self._sharded_doc_id2url = get_sharded_doc_id2url(shard_pools)
+        self._swap_lock = threading.Lock()
+        self._index = load_search_index(index_paths, version=1)
+
+    @property
+    def index(self) -> SearchIndex:
+        """
+        :return: Текущая версия индекса поиска
+        """
+        return self._index
+
+    def swap_index(self, index: SearchIndex):
+        """
+        Атомарно заменяет текущую версию индекса. Запросы, начатые до замены, дорабатывают по старой версии
+        :param index: Новая версия индекса поиска
+        """
+        with self._swap_lock:
+            self._index = index
+
+    def reload_index_if_changed(self) -> bool:
+        """
+        Загружает новую версию индекса, если файлы индекса изменились с момента загрузки текущей версии
+        :return: True, если версия индекса заменена
+        """
+        if self.shard_pools is not None:
+            return False
+        current_index = self._index
+        if get_files_version(get_index_file_paths(self.index_paths)) == current_index.files_version:
+            return False
+        with span("reload_index"):
+            new_index = load_search_index(self.index_paths, version=current_index.version + 1)
+        self.swap_index(new_index)
+        increment("index_reloads")
+        return True
+
+    def search(self, request_raw_text: str) -> SearchResult:
+        """
+        :param request_raw_text: Непредобработанная строка поискового запроса
+        :return: Документ, наиболее похожий на запрос. Мера похожести - косинусная близость векторов
+        """
+        index = self._index
+        snapshot = index.snapshot
+        with span("query"):
+            # Векторизуем запрос в TF-IDF веса его терминов
+            lemmatized_tokens = lemmatize_request(request_raw_text, lemma_cache=snapshot.lemma_cache)
+            with span("vectorize"):
+                request_tf_idf_weights = get_request_tf_idf_weights(lemmatized_tokens, token2id=snapshot.token2id,
+                                                                    token_idfs=snapshot.idf_vector,
+                                                                    kgram_index=index.kgram_index)
+            with span("cosine_similarity"):
+                if self.search_mode == "lsa":
+                    request_embedding = embed_request(index.lsa_index, request_tf_idf_weights)
+                    if self.num_probes > 0:
+                        top_doc_ids, _ = search_top_k_ivf(index.lsa_index, request_embedding, k=1,
+                                                          num_probes=self.num_probes)
+                    else:
+                        top_doc_ids, _ = search_top_k(index.lsa_index.document_embeddings, request_embedding, k=1)
+                    response_document_id = int(top_doc_ids[0])
+                    doc_id2url = self._sharded_doc_id2url if self._sharded_doc_id2url is not None \
+                        else snapshot.doc_id2url
+                    response_document_url = doc_id2url[response_document_id]
+                elif self.shard_pools is not None:
+                    _, response_document_id, response_document_url = search_vector_shards(
+                        self.shard_pools, request_tf_idf_weights, k=1)[0]
+                else:
+                    response_document_id = int(score_documents(snapshot, request_tf_idf_weights).argmax())
+                    response_document_url = snapshot.doc_id2url[response_document_id]
+            increment("queries")
+            # Путь до файла исходного непредобработанного документа
+            response_document_path = os.path.join(self.raw_documents_dir, f"review_{response_document_id}.txt")
+            with span("read_document"), codecs.open(response_document_path, 'r', encoding="utf-8") as raw_text_file:
+                document_text = raw_text_file.read().strip()
+        return SearchResult(document_id=response_document_id, document_url=response_document_url,
+                            document_text=document_text, index_version=index.version)
+
+
+def _watch_index(searcher: Searcher, check_interval: float, stop_event: threading.Event):
+    pending_files_version = None
+    failed_files_version = None
+    while not stop_event.wait(check_interval):
+        files_version = get_files_version(get_index_file_paths(searcher.index_paths))
+        if files_version in (searcher.index.files_version, failed_files_version):
+            pending_files_version = None
+            continue
+        # Файлы индекса могут ещё дописываться: загружаем их, только когда они не менялись целый интервал
+        if files_version != pending_files_version:
+            pending_files_version = files_version
+            continue
+        pending_files_version = None
+        try:
+            if searcher.reload_index_if_changed():
+                print(f"Индекс обновлён до версии {searcher.index.version}")
+        except Exception:
+            # Недостроенный индекс не должен останавливать поиск: продолжаем отвечать по старой версии
+            # и повторяем загрузку только после следующего изменения файлов
+            traceback.print_exc()
+            failed_files_version = files_version
+
+
+def start_index_watcher(searcher: Searcher, check_interval: float) -> threading.Event:
+    """
+    Запускает фоновый поток, который раз в check_interval секунд проверяет файлы индекса и при их
+    изменении загружает и подменяет версию индекса поисковика
+    :param searcher: Поисковик
+    :param check_interval: Интервал проверки файлов индекса, в секундах
+    :return: Событие, установка которого останавливает поток
+    """
+    stop_event = threading.Event()
+    threading.Thread(target=_watch_index, args=(searcher, check_interval, stop_event), daemon=True).start()
+    return stop_event
+
+
+def init_search_worker(index_paths: SearchIndexPaths, raw_documents_dir: str, search_mode: str, num_probes: int,
+                       reload_interval: float):
+    """
+    Создаёт поисковик процесса-обработчика запросов. Слепок индекса отображается в память, поэтому
+    процессы-обработчики разделяют его страницы. Каждый процесс сам следит за файлами индекса
+    :param index_paths: Пути к файлам индекса поиска
+    :param raw_documents_dir: Путь к директории непредобработанных документов
+    :param search_mode: tf_idf - поиск по разреженным TF-IDF векторам, lsa - по плотным векторам LSA
+    :param num_probes: Число просматриваемых кластеров IVF-индекса в режиме lsa. 0 - полный перебор
+    :param reload_interval: Интервал проверки файлов индекса, в секундах. 0 - не проверять
+    """
+    # Ctrl+C обрабатывает главный процесс, он же завершает обработчиков
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    searcher = Searcher(index_paths, raw_documents_dir=raw_documents_dir, search_mode=search_mode,
+                        num_probes=num_probes)
+    _worker_state["searcher"] = searcher
+    if reload_interval > 0:
+        start_index_watcher(searcher, check_interval=reload_interval)
+
+
+def search_in_worker(request_raw_text: str) -> SearchResult:
+    """
+    :param request_raw_text: Непредобработанная строка поискового запроса
+    :return: Ответ поисковика процесса-обработчика, созданного init_search_worker
+    """
+    return _worker_state["searcher"].search(request_raw_text)
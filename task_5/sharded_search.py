@@ -0,0 +1,77 @@
+import heapq
+from multiprocessing.pool import Pool
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from common.profiling import span
+from task_3.sharding import scatter_gather
+from task_5.snapshot import load_index_snapshot, score_documents
+
+# Состояние процесса-обработчика шарда: слепок индекса шарда и номер первого документа шарда
+_shard_state = {}
+
+
+def init_vector_shard_worker(snapshot_path: str, first_doc_id: int):
+    """
+    Отображает слепок индекса шарда в память процесса-обработчика шарда
+    :param snapshot_path: Путь к файлу слепка шарда
+    :param first_doc_id: Номер первого документа шарда в коллекции
+    """
+    _shard_state["snapshot"] = load_index_snapshot(snapshot_path)
+    _shard_state["first_doc_id"] = first_doc_id
+
+
+def search_vector_shard(term_weights: Dict[int, float], k: int) -> List[Tuple[float, int, str]]:
+    """
+    Находит k документов шарда, наиболее близких к запросу
+    :param term_weights: Словарь {номер термина в словаре : TF-IDF вес термина в запросе}
+    :param k: Число возвращаемых документов
+    :return: Список троек (оценка близости, номер документа в коллекции, URL документа)
+    """
+    snapshot = _shard_state["snapshot"]
+    first_doc_id = _shard_state["first_doc_id"]
+    scores = score_documents(snapshot, term_weights)
+    k = min(k, scores.shape[0])
+    if k == 0:
+        return []
+    top_doc_ids = np.argpartition(-scores, k - 1)[:k]
+    return [(float(scores[doc_id]), first_doc_id + int(doc_id), snapshot.doc_id2url.get(first_doc_id + int(doc_id)))
+            for doc_id in top_doc_ids]
+
+
+def search_vector_shards(shard_pools: List[Pool], term_weights: Dict[int, float],
+                         k: int) -> List[Tuple[float, int, str]]:
+    """
+    Рассылает запрос процессам-обработчикам всех шардов и сливает их лучшие k документов
+    :param shard_pools: Пулы процессов-обработчиков шардов, запущенные с инициализатором init_vector_shard_worker
+    :param term_weights: Словарь {номер термина в словаре : TF-IDF вес термина в запросе}
+    :param k: Число возвращаемых документов
+    :return: Список троек (оценка близости, номер документа в коллекции, URL документа) в порядке
+    убывания оценки. При равных оценках первым идёт документ с меньшим номером
+    """
+    with span("vector_search_sharded"):
+        shard_top_documents = scatter_gather(shard_pools, search_vector_shard, (term_weights, k))
+        top_documents = heapq.nsmallest(k, (document for shard_top in shard_top_documents for document in shard_top),
+                                        key=lambda document: (-document[0], document[1]))
+    return top_documents
+
+
+def get_shard_doc_id2url() -> Dict[int, str]:
+    """
+    :return: Словарь {номер документа в коллекции : URL документа} по документам шарда процесса-обработчика
+    """
+    return _shard_state["snapshot"].doc_id2url
+
+
+def get_sharded_doc_id2url(shard_pools: List[Pool]) -> Dict[int, str]:
+    """
+    Собирает URL документов всех шардов. Нужен, когда номер документа находится не обработчиками
+    шардов, а в текущем процессе, например, в режиме поиска lsa
+    :param shard_pools: Пулы процессов-обработчиков шардов, запущенные с инициализатором init_vector_shard_worker
+    :return: Словарь {номер документа в коллекции : URL документа} по всей коллекции
+    """
+    doc_id2url = {}
+    for shard_doc_id2url in scatter_gather(shard_pools, get_shard_doc_id2url, ()):
+        doc_id2url.update(shard_doc_id2url)
+    return doc_id2url
@@ -0,0 +1,300 @@
+import codecs
+import json
+import mmap
+import os
+import struct
+from argparse import ArgumentParser
+from collections import Counter, defaultdict
+from typing import Dict, List, Mapping, NamedTuple, Optional, Tuple, TYPE_CHECKING
+
+import numpy as np
+
+from common.profiling import add_profiling_arguments, finish_profiling, increment, span, start_profiling
+from task_3.sharding import get_shard_document_ranges, get_shard_path, positive_int, save_shards_meta
+from task_3.utils import load_dict
+from task_3.vocabulary import CompactVocabulary, get_id2token, serialize_vocabulary
+from task_5.utils import load_tf_idf_matrix_from_file, load_vocab_idfs, load_doc_id_url_mapping_from_index
+
+if TYPE_CHECKING:
+    from scipy.sparse import csr_matrix
+
+SNAPSHOT_MAGIC = b"IRSNAP02"
+# Массивы в файле слепка выравниваются по границе кэш-линии
+_ALIGNMENT = 64
+_HEADER_LENGTH_FORMAT = "<Q"
+
+
+class IndexSnapshot(NamedTuple):
+    """
+    Всё, что нужно векторному поиску для ответа на запрос:
+    token2id - словарь {термин : идентификатор термина}. В загруженном из файла слепке - CompactVocabulary;
+    idf_vector - массив log IDF терминов размера (размер словаря);
+    postings_indptr, postings_doc_ids, postings_weights - L2-нормированная по документам
+    TF-IDF матрица в разреженном формате по столбцам (CSC): для термина с идентификатором t
+    номера содержащих его документов лежат в postings_doc_ids[postings_indptr[t]:postings_indptr[t + 1]],
+    а соответствующие нормированные веса - в том же срезе postings_weights;
+    num_documents - число документов коллекции;
+    doc_id2url - словарь {номер документа : URL документа};
+    lemma_cache - словарь {слово в нижнем регистре : лемма}, позволяющий лемматизировать запрос
+    без загрузки моделей Natasha
+    """
+    token2id: Mapping[str, int]
+    idf_vector: np.ndarray
+    postings_indptr: np.ndarray
+    postings_doc_ids: np.ndarray
+    postings_weights: np.ndarray
+    num_documents: int
+    doc_id2url: Dict[int, str]
+    lemma_cache: Dict[str, str]
+
+
+def build_index_snapshot(token2id: Mapping[str, int], token_idfs: Dict[int, float], tf_idf_matrix: "csr_matrix",
+                         doc_id2url: Dict[int, str], lemma_cache: Optional[Dict[str, str]] = None) -> IndexSnapshot:
+    """
+    Собирает слепок индекса из загруженных в память словаря, IDF и матрицы TF-IDF
+    :param token2id: Словарь: маппинг из термина в идентификатор слова в словаре
+    :param token_idfs: Словарь: маппинг из номера термина в словаре в его значение IDF
+    :param tf_idf_matrix: Разреженная TF-IDF матрица документов коллекции
+    :param doc_id2url: Словарь {номер документа : URL документа}
+    :param lemma_cache: Словарь {слово в нижнем регистре : лемма}
+    :return: Слепок индекса
+    """
+    from sklearn.preprocessing import normalize
+
+    idf_vector = np.zeros(len(token2id), dtype=np.float64)
+    for token_id, token_idf in token_idfs.items():
+        idf_vector[token_id] = token_idf
+    # После нормировки строк косинусная близость документа и запроса пропорциональна их скалярному
+    # произведению, а норма запроса не влияет на порядок документов
+    normalized_matrix = normalize(tf_idf_matrix, norm="l2", axis=1).tocsc()
+    normalized_matrix.sort_indices()
+    return IndexSnapshot(token2id=token2id, idf_vector=idf_vector,
+                         postings_indptr=normalized_matrix.indptr.astype(np.int64),
+                         postings_doc_ids=normalized_matrix.indices.astype(np.int32),
+                         postings_weights=normalized_matrix.data.astype(np.float32),
+                         num_documents=tf_idf_matrix.shape[0], doc_id2url=doc_id2url,
+                         lemma_cache=lemma_cache if lemma_cache is not None else {})
+
+
+def split_index_snapshot(snapshot: IndexSnapshot, document_ranges: List[Tuple[int, int]]) -> List[IndexSnapshot]:
+    """
+    Делит слепок индекса на шарды из подряд идущих документов. Каждый шард хранит полный
+    словарь, глобальный вектор IDF и кэш лемм, поэтому оценки документов шарда совпадают
+    с их оценками в нешардированном слепке
+    :param snapshot: Слепок индекса всей коллекции
+    :param document_ranges: Список пар (номер первого документа шарда, число документов шарда)
+    :return: Слепки шардов. Номера документов в них локальные, отсчитываемые от первого документа шарда,
+    а doc_id2url содержит URL только документов шарда с их номерами в коллекции
+    """
+    from scipy.sparse import csc_matrix
+
+    normalized_matrix = csc_matrix((snapshot.postings_weights, snapshot.postings_doc_ids, snapshot.postings_indptr),
+                                   shape=(snapshot.num_documents, len(snapshot.token2id))).tocsr()
+    shard_snapshots = []
+    for first_doc_id, num_documents in document_ranges:
+        shard_matrix = normalized_matrix[first_doc_id:first_doc_id + num_documents].tocsc()
+        shard_matrix.sort_indices()
+        shard_doc_id2url = {doc_id: url for doc_id, url in snapshot.doc_id2url.items()
+                            if first_doc_id <= doc_id < first_doc_id + num_documents}
+        shard_snapshots.append(snapshot._replace(postings_indptr=shard_matrix.indptr.astype(np.int64),
+                                                 postings_doc_ids=shard_matrix.indices.astype(np.int32),
+                                                 postings_weights=shard_matrix.data.astype(np.float32),
+                                                 num_documents=num_documents, doc_id2url=shard_doc_id2url))
+    return shard_snapshots
+
+
+def _align(offset: int) -> int:
+    return (offset + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+
+def save_index_snapshot(snapshot_path: str, snapshot: IndexSnapshot):
+    """
+    Сохраняет слепок индекса в один бинарный файл. Формат файла: сигнатура SNAPSHOT_MAGIC,
+    длина JSON-заголовка, JSON-заголовок (маппинг документов в URL, кэш лемм и описание
+    массивов), затем выровненные по 64 байтам массивы numpy. Словарь хранится массивом байт
+    в формате компактного словаря task_3/vocabulary.py. Файл записывается рядом под временным
+    именем и затем атомарно переименовывается, поэтому уже отображённый в память слепок не
+    меняется, а читатель никогда не видит недописанный файл
+    :param snapshot_path: Путь к файлу слепка
+    :param snapshot: Слепок индекса
+    """
+    arrays = {
+        "vocabulary": np.frombuffer(serialize_vocabulary(list(get_id2token(snapshot.token2id))), dtype=np.uint8),
+        "idf_vector": snapshot.idf_vector,
+        "postings_indptr": snapshot.postings_indptr,
+        "postings_doc_ids": snapshot.postings_doc_ids,
+        "postings_weights": snapshot.postings_weights,
+    }
+    arrays_meta = {}
+    data_offset = 0
+    for name, array in arrays.items():
+        arrays_meta[name] = {"dtype": array.dtype.str, "length": int(array.shape[0]), "offset": data_offset}
+        data_offset = _align(data_offset + array.nbytes)
+    header = {
+        "num_documents": snapshot.num_documents,
+        "doc_id2url": [[doc_id, url] for doc_id, url in snapshot.doc_id2url.items()],
+        "lemma_cache": snapshot.lemma_cache,
+        "arrays": arrays_meta,
+    }
+    header_bytes = json.dumps(header, ensure_ascii=False).encode("utf-8")
+    data_start = _align(len(SNAPSHOT_MAGIC) + struct.calcsize(_HEADER_LENGTH_FORMAT) + len(header_bytes))
+    temporary_snapshot_path = f"{snapshot_path}.tmp"
+    with open(temporary_snapshot_path, "wb") as snapshot_file:
+        snapshot_file.write(SNAPSHOT_MAGIC)
+        snapshot_file.write(struct.pack(_HEADER_LENGTH_FORMAT, len(header_bytes)))
+        snapshot_file.write(header_bytes)
+        for name, array in arrays.items():
+            snapshot_file.seek(data_start + arrays_meta[name]["offset"])
+            snapshot_file.write(np.ascontiguousarray(array).tobytes())
+        # Дополняем файл до конца последнего массива, чтобы пустые массивы в конце файла тоже отображались
+        snapshot_file.truncate(data_start + data_offset)
+    os.replace(temporary_snapshot_path, snapshot_path)
+
+
+def load_index_snapshot(snapshot_path: str) -> IndexSnapshot:
+    """
+    Отображает файл слепка индекса в память. Массивы не копируются: они ссылаются
+    на страницы отображённого файла и подгружаются операционной системой по мере обращения
+    :param snapshot_path: Путь к файлу слепка, сохранённого save_index_snapshot
+    :return: Слепок индекса
+    """
+    with open(snapshot_path, "rb") as snapshot_file:
+        snapshot_mmap = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+    if snapshot_mmap[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+        raise ValueError(f"Invalid index snapshot file: {snapshot_path}")
+    header_start = len(SNAPSHOT_MAGIC) + struct.calcsize(_HEADER_LENGTH_FORMAT)
+    header_length, = struct.unpack(_HEADER_LENGTH_FORMAT, snapshot_mmap[len(SNAPSHOT_MAGIC):header_start])
+    header = json.loads(snapshot_mmap[header_start:header_start + header_length].decode("utf-8"))
+    data_start = _align(header_start + header_length)
+    arrays = {}
+    for name, array_meta in header["arrays"].items():
+        arrays[name] = np.frombuffer(snapshot_mmap, dtype=np.dtype(array_meta["dtype"]), count=array_meta["length"],
+                                     offset=data_start + array_meta["offset"])
+    token2id = CompactVocabulary(arrays.pop("vocabulary"))
+    doc_id2url = {doc_id: url for doc_id, url in header["doc_id2url"]}
+    return IndexSnapshot(token2id=token2id, num_documents=header["num_documents"], doc_id2url=doc_id2url,
+                         lemma_cache=header["lemma_cache"], **arrays)
+
+
+def load_or_build_index_snapshot(snapshot_path: Optional[str], dict_path: str, df_path: str, tf_idf_path: str,
+                                 documents_index_path: Optional[str]) -> IndexSnapshot:
+    """
+    Загружает слепок индекса из файла, если путь к нему указан, иначе собирает его из текстовых
+    файлов словаря, DF и TF-IDF
+    :param snapshot_path: Путь к файлу слепка или None
+    :param dict_path: Путь к словарю
+    :param df_path: Путь до файла с документными частотами терминов
+    :param tf_idf_path: Путь до файла cо значениями TF-IDF
+    :param documents_index_path: Путь к индекс-файлу коллекции с URL документов или None
+    :return: Слепок индекса
+    """
+    if snapshot_path is not None:
+        with span("load.snapshot"):
+            return load_index_snapshot(snapshot_path)
+    # Подгружаем словарь в память
+    with span("load.dict"):
+        token2id = load_dict(dict_path)
+    # Подгружаем предпосчитанную матрицу TF-IDF из файла
+    with span("load.tf_idf"):
+        tf_idf_matrix = load_tf_idf_matrix_from_file(tf_idf_file_path=tf_idf_path, token2id=token2id, )
+    num_documents = tf_idf_matrix.shape[0]
+    # Подгружаем инвертированные документные частоты терминов (IDF)
+    with span("load.idf"):
+        token_idfs = load_vocab_idfs(vocab_dfs_path=df_path, token2id=token2id, num_documents=num_documents)
+    doc_id2url = {}
+    if documents_index_path is not None:
+        with span("load.doc_id2url"):
+            doc_id2url = load_doc_id_url_mapping_from_index(documents_index_path)
+    with span("build.snapshot"):
+        return build_index_snapshot(token2id=token2id, token_idfs=token_idfs, tf_idf_matrix=tf_idf_matrix,
+                                    doc_id2url=doc_id2url)
+
+
+def score_documents(snapshot: IndexSnapshot, term_weights: Dict[int, float]) -> np.ndarray:
+    """
+    Считает косинусную близость (с точностью до нормы запроса) запроса и каждого документа коллекции.
+    Просматриваются только списки документов терминов запроса
+    :param snapshot: Слепок индекса
+    :param term_weights: Словарь {номер термина в словаре : TF-IDF вес термина в запросе}
+    :return: Массив оценок близости размера (число документов)
+    """
+    scores = np.zeros(snapshot.num_documents, dtype=np.float32)
+    for token_id, weight in term_weights.items():
+        start, end = snapshot.postings_indptr[token_id], snapshot.postings_indptr[token_id + 1]
+        scores[snapshot.postings_doc_ids[start:end]] += weight * snapshot.postings_weights[start:end]
+        increment("nonzeros_scored", int(end - start))
+    return scores
+
+
+def build_lemma_cache(raw_documents_dir: str) -> Dict[str, str]:
+    """
+    Лемматизирует непредобработанные документы коллекции и для каждого встреченного слова
+    запоминает его самую частую лемму
+    :param raw_documents_dir: Путь к директории непредобработанных документов
+    :return: Словарь {слово в нижнем регистре : лемма}
+    """
+    from task_2.code.task_2 import get_token_lemma_pairs, load_natasha_models
+
+    segmenter, morph_tagger, morph_vocab = load_natasha_models()
+    word_lemma_counters = defaultdict(Counter)
+    for document_fname in sorted(os.listdir(raw_documents_dir)):
+        with codecs.open(os.path.join(raw_documents_dir, document_fname), 'r', encoding="utf-8") as raw_text_file:
+            token_lemma_pairs = get_token_lemma_pairs(raw_text=raw_text_file.read(), segmenter=segmenter,
+                                                      morph_tagger=morph_tagger, morph_vocab=morph_vocab)
+        for word, lemma in token_lemma_pairs:
+            word_lemma_counters[word.lower()][lemma] += 1
+    lemma_cache = {word: lemma_counter.most_common(1)[0][0] for word, lemma_counter in word_lemma_counters.items()}
+    return lemma_cache
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--input_dict_path', default=r"../task_2/tokenized_texts/dict.txt", type=str,
+                        help="Путь к словарю")
+    parser.add_argument('--input_df_path', default="../task_4/tf_idf/df.txt",
+                        type=str, help=r"Путь до файла с документными частотами терминов")
+    parser.add_argument('--input_tf_idf_path', default="../task_4/tf_idf/tf_idf.txt",
+                        type=str, help=r"Путь до файла cо значениями TF-IDF")
+    parser.add_argument('--input_documents_index', default=r"../task_1/reviews/index.txt", type=str,
+                        help="Путь к индекс-файлу коллекции, содержащему маппинг номеров"
+                             "документов в URL этих документов")
+    parser.add_argument('--input_raw_documents_dir', default=None, type=str,
+                        help="Путь к директории непредобработанных документов. Если указан, в слепок "
+                             "добавляется кэш лемм слов коллекции, и запросы из этих слов лемматизируются "
+                             "без загрузки моделей Natasha")
+    parser.add_argument('--output_snapshot_path', default=r"index_snapshot/index.snapshot", type=str,
+                        help="Выходной путь файла слепка индекса")
+    parser.add_argument('--num_shards', default=1, type=positive_int,
+                        help="Число шардов слепка. При значении больше 1 слепок каждого шарда записывается в файл "
+                             "<output_snapshot_path>_shard_<номер шарда>, а описание шардов - в файл "
+                             "output_shards_path")
+    parser.add_argument('--output_shards_path', default=r"index_snapshot/shards.txt", type=str,
+                        help="Выходной путь файла описания шардов")
+    add_profiling_arguments(parser)
+    args = parser.parse_args()
+    start_profiling(args)
+    output_snapshot_path = args.output_snapshot_path
+    output_dir = os.path.dirname(output_snapshot_path)
+    if not os.path.exists(output_dir) and output_dir != '':
+        os.makedirs(output_dir)
+
+    snapshot = load_or_build_index_snapshot(snapshot_path=None, dict_path=args.input_dict_path,
+                                            df_path=args.input_df_path, tf_idf_path=args.input_tf_idf_path,
+                                            documents_index_path=args.input_documents_index)
+    if args.input_raw_documents_dir is not None:
+        with span("build.lemma_cache"):
+            snapshot = snapshot._replace(lemma_cache=build_lemma_cache(args.input_raw_documents_dir))
+    with span("save.snapshot"):
+        if args.num_shards == 1:
+            save_index_snapshot(snapshot_path=output_snapshot_path, snapshot=snapshot)
+        else:
+            document_ranges = get_shard_document_ranges(snapshot.num_documents, args.num_shards)
+            shard_paths = [get_shard_path(output_snapshot_path, shard_id) for shard_id in range(args.num_shards)]
+            for shard_path, shard_snapshot in zip(shard_paths, split_index_snapshot(snapshot, document_ranges)):
+                save_index_snapshot(snapshot_path=shard_path, snapshot=shard_snapshot)
+            save_shards_meta(args.output_shards_path, shard_paths=shard_paths, document_ranges=document_ranges)
+    finish_profiling(args)
+
+
+if __name__ == '__main__':
+    main()
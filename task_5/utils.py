@@ -1,17 +1,21 @@
 import codecs
 import math
-from typing import Dict
+from typing import Dict, TYPE_CHECKING
 
-from scipy.sparse import csr_matrix
+if TYPE_CHECKING:
+    from scipy.sparse import csr_matrix
 
 
-def load_tf_idf_matrix_from_file(tf_idf_file_path: str, token2id: Dict[str, int], sep_str: str = "~~~") -> csr_matrix:
+def load_tf_idf_matrix_from_file(tf_idf_file_path: str, token2id: Dict[str, int],
+                                 sep_str: str = "~~~") -> "csr_matrix":
     """
     :param tf_idf_file_path: Путь к файлу с TF-IDF значениями слов документов
     :param token2id: Словарь: маппинг из термина в идентификатор слова в словаре
     :param sep_str: Разделитель между термином и его значениями IDF и TF-IDF
     :return: Разреженная TF-IDF матрица документов коллекции
     """
+    from scipy.sparse import csr_matrix
+
     with codecs.open(tf_idf_file_path, 'r', encoding="utf-8") as input_file:
         vocab_size = len(token2id.keys())
         row_indices = []
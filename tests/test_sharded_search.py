@@ -0,0 +1,93 @@
+import codecs
+import os
+import tempfile
+import unittest
+
+import numpy as np
+from scipy.sparse import random as sparse_random
+
+from task_3.sharding import get_shard_document_ranges, get_shard_path, start_shard_workers, stop_shard_workers
+from task_3.vocabulary import get_vocabulary_fingerprint
+from task_5.lsa_search import build_lsa_index, save_lsa_index
+from task_5.searcher import Searcher, SearchIndexPaths
+from task_5.sharded_search import init_vector_shard_worker
+from task_5.snapshot import build_index_snapshot, save_index_snapshot, split_index_snapshot
+
+TERMS = ["книга", "автор", "сюжет", "герой", "роман", "читать", "глава", "финал"]
+NUM_DOCUMENTS = 30
+NUM_SHARDS = 3
+
+
+class ShardedSearchTest(unittest.TestCase):
+    """
+    Поиск по шардированному слепку должен отвечать так же, как поиск по слепку всей коллекции
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.temporary_dir = tempfile.TemporaryDirectory()
+        work_dir = cls.temporary_dir.name
+        token2id = {term: term_id for term_id, term in enumerate(TERMS)}
+        tf_idf_matrix = sparse_random(NUM_DOCUMENTS, len(TERMS), density=0.4, format="csr", random_state=0,
+                                      dtype=np.float64)
+        doc_id2url = {doc_id: f"https://example.org/review_{doc_id}" for doc_id in range(NUM_DOCUMENTS)}
+        snapshot = build_index_snapshot(token2id=token2id, token_idfs={term_id: 1.0 for term_id in range(len(TERMS))},
+                                        tf_idf_matrix=tf_idf_matrix, doc_id2url=doc_id2url,
+                                        lemma_cache={term: term for term in TERMS})
+        cls.snapshot_path = os.path.join(work_dir, "index.snapshot")
+        save_index_snapshot(cls.snapshot_path, snapshot)
+        document_ranges = get_shard_document_ranges(NUM_DOCUMENTS, NUM_SHARDS)
+        shard_snapshots = split_index_snapshot(snapshot, document_ranges)
+        shard_initargs = []
+        for shard_id, shard_snapshot in enumerate(shard_snapshots):
+            shard_path = get_shard_path(cls.snapshot_path, shard_id)
+            save_index_snapshot(shard_path, shard_snapshot)
+            shard_initargs.append((shard_path, document_ranges[shard_id][0]))
+        cls.shard_paths = [shard_path for shard_path, _ in shard_initargs]
+        cls.shard_pools = start_shard_workers(init_vector_shard_worker, shard_initargs)
+        cls.lsa_index_dir = os.path.join(work_dir, "lsa_index")
+        save_lsa_index(cls.lsa_index_dir, build_lsa_index(tf_idf_matrix, num_components=4),
+                       vocabulary_fingerprint=get_vocabulary_fingerprint(token2id))
+        cls.raw_documents_dir = os.path.join(work_dir, "reviews")
+        os.makedirs(cls.raw_documents_dir)
+        for doc_id in range(NUM_DOCUMENTS):
+            with codecs.open(os.path.join(cls.raw_documents_dir, f"review_{doc_id}.txt"), 'w+',
+                             encoding="utf-8") as raw_text_file:
+                raw_text_file.write(f"Отзыв {doc_id}")
+
+    @classmethod
+    def tearDownClass(cls):
+        stop_shard_workers(cls.shard_pools)
+        cls.temporary_dir.cleanup()
+
+    def _create_searchers(self, search_mode: str):
+        index_paths = SearchIndexPaths(dict_path='', df_path='', tf_idf_path='', documents_index_path='',
+                                       snapshot_path=self.snapshot_path,
+                                       lsa_index_dir=self.lsa_index_dir if search_mode == "lsa" else None)
+        searcher = Searcher(index_paths, raw_documents_dir=self.raw_documents_dir, search_mode=search_mode)
+        sharded_searcher = Searcher(index_paths, raw_documents_dir=self.raw_documents_dir, search_mode=search_mode,
+                                    shard_pools=self.shard_pools, shards_snapshot_path=self.shard_paths[0])
+        return searcher, sharded_searcher
+
+    def _assert_same_results(self, search_mode: str):
+        searcher, sharded_searcher = self._create_searchers(search_mode)
+        requests = TERMS + [f"{TERMS[i]} {TERMS[i + 1]}" for i in range(len(TERMS) - 1)]
+        found_doc_ids = set()
+        for request in requests:
+            result = searcher.search(request)
+            sharded_result = sharded_searcher.search(request)
+            self.assertEqual(result, sharded_result, msg=request)
+            found_doc_ids.add(result.document_id)
+        # Ответы должны попадать не только в первый шард
+        first_shard_size = get_shard_document_ranges(NUM_DOCUMENTS, NUM_SHARDS)[0][1]
+        self.assertTrue(any(doc_id >= first_shard_size for doc_id in found_doc_ids))
+
+    def test_tf_idf_sharded_results_match(self):
+        self._assert_same_results("tf_idf")
+
+    def test_lsa_sharded_results_match(self):
+        self._assert_same_results("lsa")
+
+
+if __name__ == '__main__':
+    unittest.main()